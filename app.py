@@ -2,11 +2,34 @@ import streamlit as st
 import subprocess
 import os
 import pandas as pd
+import numpy as np
 import json
 import glob
 import io
+import hashlib
+import string
 import zipfile
+import tempfile
+import collections
+import shutil
+import threading
+import queue
+import weakref
+import time
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# orjsonがあれば高速なJSONパーサーを使う（なければ標準のjson）
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# blake3があれば高速なハッシュ関数を使う（なければ標準のblake2b）
+try:
+    import blake3
+except ImportError:
+    blake3 = None
 
 # ==========================================
 # 設定：各仮想環境のPythonパス (WSL2環境に合わせて変更してください)
@@ -25,44 +48,387 @@ SCRIPT_MERGE = f"{SCRIPT_DIR}/step3_merge.py"
 TEMP_DIR = "temp"
 os.makedirs(TEMP_DIR, exist_ok=True)
 
+# ZIP生成時にメモリ上で保持する上限 (超えた分は一時ファイルへ退避)
+ZIP_SPOOL_MAX_SIZE = 8 * 1024 * 1024
+
+# コマンド失敗時にエラー表示用として保持する出力の行数
+COMMAND_OUTPUT_TAIL_LINES = 200
+
+# ワーカーのジョブ実行中にログ末尾を表示し直す間隔 (秒)
+WORKER_LOG_POLL_INTERVAL = 1.0
+# 進捗表示のためにワーカーログの末尾から読む量
+WORKER_LOG_TAIL_BYTES = 4096
+
+# 同時に常駐させるモデルワーカーの上限 (ワーカーごとにモデルをGPUメモリへ読み込むため)
+MAX_RESIDENT_WORKERS = 4
+
+# アップロードファイルを一時保存する際のコピー単位
+UPLOAD_COPY_CHUNK_SIZE = 4 * 1024 * 1024
+
+# 処理結果のキャッシュ保存場所 (音声ファイルの内容ハッシュごとにフォルダを作る)
+CACHE_DIR = os.path.join(TEMP_DIR, "cache")
+# キャッシュの保存期間 (最後に書き込んでからこの日数を過ぎたものは削除する)
+CACHE_RETENTION_DAYS = 7
+HASH_CHUNK_SIZE = 1024 * 1024
+
 # ==========================================
 # ヘルパー関数
 # ==========================================
 # ==========================================
 # ヘルパー関数
 # ==========================================
-def run_command(command_list, description, env=None):
-    """サブプロセスを実行し、エラーがあればStreamlit上で通知する"""
+def execute_command(command_list, env=None, on_output=None):
+    """サブプロセスを実行し、(成功可否, 例外) を返す
+    出力は1行ずつ読み取り、on_outputが指定されていれば逐次渡す（エラー表示用に末尾のみ保持）
+    ※Streamlitを呼び出さないため、ワーカースレッドからも利用できる"""
+    # コマンドリストの要素を文字列に変換（念のため）
+    cmd_str_list = [str(item) for item in command_list]
+
+    # 環境変数のマージ（Pythonスクリプトの出力をバッファリングさせず逐次流す）
+    run_env = os.environ.copy()
+    run_env["PYTHONUNBUFFERED"] = "1"
+    if env:
+        run_env.update(env)
+
     try:
-        # コマンドリストの要素を文字列に変換（念のため）
-        cmd_str_list = [str(item) for item in command_list]
-        st.write(f"Executing: {' '.join(cmd_str_list)}") # デバッグ用表示
-        
-        # 環境変数のマージ
+        # stdoutもstderrに合流させる（ffmpegは進捗をstderr、各スクリプトはprintでstdoutに出す）
+        proc = subprocess.Popen(
+            cmd_str_list,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+            errors="replace",
+            env=run_env
+        )
+    except FileNotFoundError as e:
+        return False, e
+
+    output_tail = collections.deque(maxlen=COMMAND_OUTPUT_TAIL_LINES)
+    with proc:
+        for line in proc.stdout:
+            output_tail.append(line)
+            if on_output and line.strip():
+                on_output(line.strip())
+    if proc.returncode != 0:
+        return False, subprocess.CalledProcessError(proc.returncode, cmd_str_list, stderr="".join(output_tail))
+    return True, None
+
+def report_command_error(description, command_list, error):
+    """execute_commandの失敗内容をStreamlit上で通知する"""
+    if isinstance(error, subprocess.CalledProcessError):
+        st.error(f"エラーが発生しました: {description}")
+        st.error(f"Command: {' '.join(error.cmd)}")
+        st.code(error.stderr) # エラー詳細を表示 (出力の末尾)
+    else:
+        st.error(f"コマンドが見つかりません: {command_list[0]}")
+        st.info("Pythonパスやffmpegのインストールを確認してください。")
+
+def run_command(command_list, description, env=None, status_area=None):
+    """サブプロセスを実行し、エラーがあればStreamlit上で通知する
+    status_areaが指定されていれば、実行中の出力を逐次表示する"""
+    cmd_str_list = [str(item) for item in command_list]
+    st.write(f"Executing: {' '.join(cmd_str_list)}") # デバッグ用表示
+
+    on_output = None
+    if status_area is not None:
+        on_output = lambda line: status_area.text(f"⏳ {description}: {line}")
+
+    success, error = execute_command(cmd_str_list, env=env, on_output=on_output)
+    if not success:
+        report_command_error(description, cmd_str_list, error)
+    return success
+
+class ModelWorker:
+    """モデルを読み込んだまま常駐するサブプロセス (各スクリプトの --serve モード)
+    stdinにJSON 1行でジョブを送り、stdoutからJSON 1行で結果を受け取る"""
+
+    def __init__(self, command_list, log_path, env=None):
+        self.command_list = [str(item) for item in command_list]
+        self.env = env or {}
+        self.log_path = log_path
+        self._lock = threading.Lock()
+
+        # 環境変数のマージ (HF_TOKEN等は起動時に渡す)
         run_env = os.environ.copy()
-        if env:
-            run_env.update(env)
+        run_env.update(self.env)
 
-        result = subprocess.run(
-            cmd_str_list, 
-            check=True, 
-            capture_output=True, 
+        # ログはパイプに溜めず、ファイルへ書き出す（パイプ詰まりによる停止を防ぐ）
+        log_file = open(log_path, "w", encoding="utf-8")
+        self.proc = subprocess.Popen(
+            self.command_list,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=log_file,
             text=True,
+            encoding="utf-8",
             env=run_env
         )
-        return True
-    except subprocess.CalledProcessError as e:
-        st.error(f"エラーが発生しました: {description}")
-        st.error(f"Command: {' '.join(e.cmd)}")
-        st.code(e.stderr) # エラー詳細を表示
-        return False
+        # 破棄・再起動時にプロセスを終了させる
+        self._finalizer = weakref.finalize(self, ModelWorker._shutdown, self.proc, log_file)
+
+    @staticmethod
+    def _shutdown(proc, log_file):
+        if proc.poll() is None:
+            proc.terminate()
+            try:
+                proc.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+        log_file.close()
+
+    def is_alive(self):
+        return self.proc.poll() is None
+
+    def is_busy(self):
+        """ジョブを処理中かどうか"""
+        return self._lock.locked()
+
+    def close(self):
+        self._finalizer()
+
+    def request(self, job):
+        """ジョブを1件処理して結果(dict)を返す
+        ※Streamlitを呼び出さないため、ワーカースレッドからも利用できる"""
+        with self._lock:
+            try:
+                self.proc.stdin.write(json.dumps(job, ensure_ascii=False) + "\n")
+                self.proc.stdin.flush()
+                line = self.proc.stdout.readline()
+            except OSError:
+                line = ""
+        if not line:
+            # 応答が途切れたワーカーは破棄し、次回取得時に起動し直す
+            self.close()
+            return {"ok": False, "error": "ワーカープロセスが終了しました。ログを確認してください。"}
+        try:
+            return json.loads(line)
+        except json.JSONDecodeError:
+            # 応答以外の出力が混ざったワーカーはプロトコルが壊れているため破棄する
+            self.close()
+            return {"ok": False, "error": f"ワーカーから不正な応答を受け取りました: {line.strip()[:200]}"}
+
+    def read_log_tail(self, max_lines=50):
+        """ワーカーログの末尾を返す（エラー表示用）"""
+        try:
+            with open(self.log_path, encoding="utf-8", errors="replace") as f:
+                return "".join(f.readlines()[-max_lines:])
+        except OSError:
+            return ""
+
+    def read_last_line(self):
+        """ワーカーログの最後の1行を返す（進捗表示用。ファイル末尾だけを読む）"""
+        try:
+            with open(self.log_path, "rb") as f:
+                f.seek(0, os.SEEK_END)
+                f.seek(max(0, f.tell() - WORKER_LOG_TAIL_BYTES))
+                tail = f.read().decode("utf-8", errors="replace")
+        except OSError:
+            return ""
+        lines = tail.strip().splitlines()
+        # tqdmの進捗バーは\rで上書きされるため、最後の表示だけを使う
+        return lines[-1].split("\r")[-1].strip() if lines else ""
+
+class ModelWorkerPool:
+    """常駐ワーカーを名前ごとに管理する（全セッションで共有）
+    ※上限を超える場合は、最も長く使われていない待機中のワーカーから終了させる"""
+
+    def __init__(self, max_workers=MAX_RESIDENT_WORKERS):
+        self._lock = threading.Lock()
+        self._workers = {} # 使われた順 (末尾が最新)
+        self.max_workers = max_workers
+
+    def get(self, name, command_list, env=None):
+        """ワーカーを返す。未起動・異常終了・環境変数が変わった場合は起動し直す"""
+        with self._lock:
+            worker = self._workers.pop(name, None)
+            if worker is not None and (not worker.is_alive() or worker.env != (env or {})):
+                worker.close()
+                worker = None
+            if worker is None:
+                self._evict(self.max_workers - 1)
+                log_path = os.path.join(TEMP_DIR, f"worker_{name}.log")
+                worker = ModelWorker(command_list, log_path, env)
+            self._workers[name] = worker
+            return worker
+
+    def close(self, names):
+        """指定した名前のワーカーを終了する（処理中のものは残す）"""
+        with self._lock:
+            for name in names:
+                worker = self._workers.get(name)
+                if worker is not None and not worker.is_busy():
+                    worker.close()
+                    del self._workers[name]
+
+    def _evict(self, limit):
+        """常駐数がlimit以下になるまで、古い順に待機中のワーカーを終了する"""
+        for name, worker in list(self._workers.items()):
+            if len(self._workers) <= limit:
+                break
+            if not worker.is_alive() or not worker.is_busy():
+                worker.close()
+                del self._workers[name]
+
+@st.cache_resource
+def get_worker_pool():
+    """Streamlitの再実行を跨いでワーカーを保持する"""
+    return ModelWorkerPool()
+
+def acquire_worker(name, command_list, env=None):
+    """常駐ワーカーを取得する。起動できない場合はStreamlit上で通知してNoneを返す"""
+    try:
+        return get_worker_pool().get(name, command_list, env)
     except FileNotFoundError:
         st.error(f"コマンドが見つかりません: {command_list[0]}")
         st.info("Pythonパスやffmpegのインストールを確認してください。")
+        return None
+
+def get_whisper_worker(slot=0):
+    """Step 1 (Whisper) の常駐ワーカー。並列実行時はslotごとに別プロセスを使う"""
+    return acquire_worker(f"whisper{slot}", [WHISPER_PYTHON_PATH, SCRIPT_TRANSCRIBE, "--serve"])
+
+def release_whisper_workers(max_workers):
+    """並列数を下げた場合に、使わなくなったslotのWhisperワーカーを終了する"""
+    get_worker_pool().close([f"whisper{slot}" for slot in range(max_workers, MAX_RESIDENT_WORKERS)])
+
+# 話者埋め込みモデルの実行方式: 表示名 -> (ワーカー名, step2_diarize.py の追加オプション)
+EMBEDDING_BACKENDS = {
+    "PyTorch (標準)": ("pyannote", []),
+    "ONNX Runtime FP32 (GPU向け)": ("pyannote_onnx", ["--onnx"]),
+    "ONNX Runtime int8 (CPU向け)": ("pyannote_int8", ["--quantized"]),
+}
+
+def get_pyannote_worker(hf_token, embedding_backend="PyTorch (標準)"):
+    """Step 2 (Pyannote) の常駐ワーカー（埋め込みモデルの実行方式ごとに別プロセス）"""
+    name, options = EMBEDDING_BACKENDS[embedding_backend]
+    # 他の実行方式のワーカーは終了する（パイプラインを複数保持してVRAMを圧迫しないように）
+    get_worker_pool().close([other for other, _ in EMBEDDING_BACKENDS.values() if other != name])
+    return acquire_worker(name, [PYANNOTE_PYTHON_PATH, SCRIPT_DIARIZE, "--serve"] + options, env={"HF_TOKEN": hf_token})
+
+def report_worker_error(description, result, worker):
+    """ModelWorker.requestの失敗内容をStreamlit上で通知する"""
+    st.error(f"エラーが発生しました: {description}")
+    st.error(result["error"])
+    st.code(worker.read_log_tail()) # エラー詳細を表示
+
+def iter_completed_with_progress(futures, status_area, get_running):
+    """as_completedと同様に完了したジョブを順に返す。
+    待っている間は、実行中のワーカー（get_runningが返す (説明, worker) の一覧）のログ末尾をstatus_areaに表示する"""
+    pending = set(futures)
+    while pending:
+        done, pending = wait(pending, timeout=WORKER_LOG_POLL_INTERVAL, return_when=FIRST_COMPLETED)
+        if not done:
+            status_area.text("\n".join(
+                f"⏳ {description} 実行中: {worker.read_last_line()}"
+                for description, worker in get_running()
+            ))
+        yield from done
+
+def run_worker_jobs(tasks, status_area, progress_bar, progress_start, progress_end):
+    """依存関係のない常駐ワーカーのジョブ（worker, job, description）を同時に実行する
+    ※ジョブはそれぞれ別プロセスで処理されるため、所要時間は最も遅いジョブ分で済む"""
+    for worker, job, description in tasks:
+        st.write(f"Worker job ({description}): {json.dumps(job, ensure_ascii=False)}") # デバッグ用表示
+
+    total = len(tasks)
+    all_ok = True
+    with ThreadPoolExecutor(max_workers=total) as executor:
+        futures = {
+            executor.submit(worker.request, job): (worker, description)
+            for worker, job, description in tasks
+        }
+
+        # 完了したジョブから順に進捗を表示（Streamlitの呼び出しはメインスレッドで行う）
+        def get_running():
+            return [(description, worker) for future, (worker, description) in futures.items() if not future.done()]
+
+        completed = 0
+        for future in iter_completed_with_progress(futures, status_area, get_running):
+            worker, description = futures[future]
+            result = future.result()
+            if not result["ok"]:
+                report_worker_error(description, result, worker)
+                all_ok = False
+                continue
+
+            completed += 1
+            status_area.text(f"⏳ {description} 完了 ({completed}/{total})...")
+            progress_bar.progress(progress_start + (progress_end - progress_start) * completed // total)
+
+    return all_ok
+
+def build_transcribe_job(input_wav, initial_prompt, batched=False):
+    """Step 1 (Whisper) のジョブを組み立てる"""
+    return {"input": input_wav, "prompt": initial_prompt, "batched": batched}
+
+def transcribe_channels(channel_files, initial_prompt, batched, max_workers, status_area, progress_bar):
+    """各チャネルの文字起こしを常駐Whisperワーカーで並列実行する
+    ※ワーカーごとにモデルを1つ保持するため、並列数はGPUのVRAMで制限する"""
+    release_whisper_workers(max_workers)
+    workers = [get_whisper_worker(slot) for slot in range(max_workers)]
+    if None in workers:
         return False
 
+    # 空いているワーカーにジョブを割り当てる
+    idle_workers = queue.Queue()
+    for worker in workers:
+        idle_workers.put(worker)
+
+    # 実行中のチャネル -> worker（進捗表示用）
+    running = {}
+
+    def run_job(i, job):
+        worker = idle_workers.get()
+        running[i] = worker
+        try:
+            return worker, worker.request(job)
+        finally:
+            running.pop(i, None)
+            idle_workers.put(worker)
+
+    def get_running():
+        return [(f"Channel {i+1}", worker) for i, worker in sorted(running.copy().items())]
+
+    total = len(channel_files)
+    jobs = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for i, ch_file in enumerate(channel_files):
+            job = build_transcribe_job(ch_file, initial_prompt, batched)
+            st.write(f"Worker job (Whisper Ch {i+1}): {json.dumps(job, ensure_ascii=False)}") # デバッグ用表示
+            jobs[executor.submit(run_job, i, job)] = i
+
+        # 完了したチャネルから順に進捗を表示（Streamlitの呼び出しはメインスレッドで行う）
+        completed = 0
+        for future in iter_completed_with_progress(jobs, status_area, get_running):
+            i = jobs[future]
+            worker, result = future.result()
+            if not result["ok"]:
+                report_worker_error(f"Whisper (Ch {i+1})", result, worker)
+                st.error(f"Channel {i+1} の処理中にエラーが発生しました。")
+                # 未着手のジョブは実行しない
+                for pending in jobs:
+                    pending.cancel()
+                return False
+
+            completed += 1
+            status_area.text(f"⏳ 文字起こし中: Channel {i+1} 完了 ({completed}/{total})...")
+            progress_bar.progress(20 + 50 * completed // total)
+
+    return True
+
 def get_audio_info(file_path):
-    """ffprobeを使って音声ファイルの情報を取得する"""
+    """音声ファイルの情報を取得する（ファイルが更新されていなければffprobeを再実行しない）"""
+    # 失敗時の既定値はキャッシュしない（書き込み途中のファイルなど一時的な失敗を次回の実行で解析し直すため）
+    try:
+        return probe_audio_info(file_path, os.stat(file_path).st_mtime_ns)
+    except Exception as e:
+        st.error(f"メタデータ解析エラー: {e}")
+        return {"channels": 1, "sample_rate": 0}
+
+@st.cache_data(show_spinner=False)
+def probe_audio_info(file_path, mtime_ns):
+    """ffprobeを使って音声ファイルの情報を取得する（失敗時は例外を送出する）
+    ※mtime_nsはキャッシュキー用（ファイル更新時に再解析させる）"""
     cmd = [
         "ffprobe",
         "-v", "quiet",
@@ -70,39 +436,15 @@ def get_audio_info(file_path):
         "-show_streams",
         file_path
     ]
-    try:
-        result = subprocess.run(cmd, capture_output=True, text=True, check=True)
-        data = json.loads(result.stdout)
-        for stream in data.get("streams", []):
-            if stream.get("codec_type") == "audio":
-                return {
-                    "channels": int(stream.get("channels", 1)),
-                    "sample_rate": int(stream.get("sample_rate", 0))
-                }
-    except Exception as e:
-        st.error(f"メタデータ解析エラー: {e}")
-    return {"channels": 1, "sample_rate": 0}
-
-def split_channels(input_path, channels):
-    """マルチチャネル音声をチャネルごとに分割する"""
-    filename = Path(input_path).stem
-    output_files = []
-    
-    for i in range(channels):
-        # ch1, ch2, ... (1-based index for filename, 0-based for ffmpeg c0=c{i})
-        out_file = os.path.join(TEMP_DIR, f"{filename}_ch{i+1}.wav")
-        # pan filter to extract specific channel
-        cmd = [
-            "ffmpeg", "-y",
-            "-i", input_path,
-            "-af", f"pan=mono|c0=c{i}",
-            "-ar", "16000",
-            out_file
-        ]
-        if run_command(cmd, f"チャネル{i+1}抽出"):
-            output_files.append(out_file)
-            
-    return output_files
+    result = subprocess.run(cmd, capture_output=True, text=True, check=True)
+    data = orjson.loads(result.stdout) if orjson else json.loads(result.stdout)
+    for stream in data.get("streams", []):
+        if stream.get("codec_type") == "audio":
+            return {
+                "channels": int(stream.get("channels", 1)),
+                "sample_rate": int(stream.get("sample_rate", 0))
+            }
+    raise ValueError("音声ストリームが見つかりません")
 
 def build_initial_prompt(user_text: str) -> str:
     """法廷用語プロンプトを生成する"""
@@ -118,11 +460,10 @@ def build_initial_prompt(user_text: str) -> str:
     else:
         return system_text
 
-def convert_and_denoise(input_path):
-    """Step 0: ffmpegを使って周波数カット＋ノイズ除去を行い、WAV変換する"""
-    # 出力ファイル名
+def convert_split_denoise(input_path, channels, status_area=None):
+    """Step 0: ffmpegを1回だけ起動し、周波数カット＋ノイズ除去＋(必要なら)チャネル分割を行いWAV変換する
+    channels <= 1 の場合はモノラル化した1ファイル、それ以外はチャネルごとのファイルを返す"""
     filename = Path(input_path).stem
-    output_path = os.path.join(TEMP_DIR, f"{filename}_clean.wav")
     
     # フィルタチェーンの構築
     # 順序: ハイパス(低音カット) -> ローパス(高音カット) -> ノイズ除去(afftdn)
@@ -133,89 +474,120 @@ def convert_and_denoise(input_path):
     # 3. afftdn=nr=20: 残った帯域内の定常ノイズ（サーッという音）をAIで低減。
     audio_filters = "highpass=f=200,lowpass=f=3000,afftdn=nr=20"
 
-    cmd = [
-        "ffmpeg", "-y",
-        "-i", input_path,
-        "-af", audio_filters,   # 統合したフィルタを適用
-        "-ar", "16000",         # サンプリングレート 16kHz
-        "-ac", "1",             # モノラル化
-        output_path
-    ]
-    
-    success = run_command(cmd, "Step 0: バンドパス＆ノイズ除去フィルタ適用")
-    return output_path if success else None
+    if channels <= 1:
+        output_files = [os.path.join(TEMP_DIR, f"{filename}_clean.wav")]
+        cmd = [
+            "ffmpeg", "-y",
+            "-i", input_path,
+            "-af", audio_filters,   # 統合したフィルタを適用
+            "-ar", "16000",         # サンプリングレート 16kHz
+            "-ac", "1",             # モノラル化
+            output_files[0]
+        ]
+        description = "Step 0: バンドパス＆ノイズ除去フィルタ適用"
+    else:
+        # 1回のデコードでフィルタを共有し、asplitで分岐 -> panで各チャネルを抽出
+        # ch1, ch2, ... (1-based index for filename, 0-based for ffmpeg c0=c{i})
+        split_labels = "".join(f"[a{i+1}]" for i in range(channels))
+        graph = [f"[0:a]{audio_filters},asplit={channels}{split_labels}"]
+        graph += [f"[a{i+1}]pan=mono|c0=c{i}[o{i+1}]" for i in range(channels)]
 
-def format_timestamp(seconds):
-    """秒数をHH:MM:SS形式に変換する"""
-    hours = int(seconds // 3600)
-    minutes = int((seconds % 3600) // 60)
-    secs = int(seconds % 60)
-    return f"{hours:02d}:{minutes:02d}:{secs:02d}"
+        output_files = []
+        cmd = [
+            "ffmpeg", "-y",
+            "-i", input_path,
+            "-filter_complex", ";".join(graph)
+        ]
+        for i in range(channels):
+            out_file = os.path.join(TEMP_DIR, f"{filename}_ch{i+1}.wav")
+            cmd += ["-map", f"[o{i+1}]", "-ar", "16000", out_file]
+            output_files.append(out_file)
+        description = "Step 0: ノイズ除去＆チャネル分割"
+    
+    success = run_command(cmd, description, status_area=status_area)
+    return output_files if success else []
 
-def generate_html_player(df, base_filename, audio_filename):
-    """HTMLプレイヤーを生成する"""
-    rows = ""
-    for _, row in df.iterrows():
-        time_formatted = format_timestamp(row['Start'])
-        rows += f"<tr><td class='time-col'><span class='timestamp' onclick='seek({row['Start']})'>{time_formatted}</span></td><td class='speaker-col'>{row['Speaker']}</td><td>{row['Text']}</td></tr>"
+def format_timestamps(seconds):
+    """秒数の配列をHH:MM:SS形式の文字列リストに変換する"""
+    seconds = np.asarray(seconds, dtype=np.float64)
+    hours = (seconds // 3600).astype(np.int64)
+    minutes = ((seconds % 3600) // 60).astype(np.int64)
+    secs = (seconds % 60).astype(np.int64)
+    return [f"{h:02d}:{m:02d}:{s:02d}" for h, m, s in zip(hours.tolist(), minutes.tolist(), secs.tolist())]
 
-    html_content = f"""<!DOCTYPE html>
+# HTMLプレイヤーの雛形（読み込み時に一度だけ組み立て、呼び出し時は差し込みのみ行う）
+PLAYER_HTML_TEMPLATE = string.Template("""<!DOCTYPE html>
 <html lang="ja">
 <head>
     <meta charset="UTF-8">
-    <title>{base_filename} の文字起こし</title>
+    <title>${base_filename} の文字起こし</title>
     <style>
-        body {{ font-family: sans-serif; margin: 20px; }}
-        audio {{ width: 100%; position: sticky; top: 0; background: white; border-bottom: 1px solid #ccc; }}
-        table {{ width: 100%; border-collapse: collapse; margin-top: 20px; }}
-        th, td {{ border: 1px solid #ccc; padding: 8px; text-align: left; vertical-align: top; }}
-        th {{ background-color: #f2f2f2; }}
-        .time-col {{ white-space: nowrap; width: 80px; }}
-        .speaker-col {{ white-space: nowrap; width: 120px; font-weight: bold; }}
-        .timestamp {{ color: #007bff; cursor: pointer; text-decoration: underline; }}
-        .timestamp:hover {{ color: #0056b3; }}
+        body { font-family: sans-serif; margin: 20px; }
+        audio { width: 100%; position: sticky; top: 0; background: white; border-bottom: 1px solid #ccc; }
+        table { width: 100%; border-collapse: collapse; margin-top: 20px; }
+        th, td { border: 1px solid #ccc; padding: 8px; text-align: left; vertical-align: top; }
+        th { background-color: #f2f2f2; }
+        .time-col { white-space: nowrap; width: 80px; }
+        .speaker-col { white-space: nowrap; width: 120px; font-weight: bold; }
+        .timestamp { color: #007bff; cursor: pointer; text-decoration: underline; }
+        .timestamp:hover { color: #0056b3; }
     </style>
 </head>
 <body>
-    <h2>{base_filename} の文字起こし</h2>
-    <audio id="player" controls src="{audio_filename}"></audio>
+    <h2>${base_filename} の文字起こし</h2>
+    <audio id="player" controls src="${audio_filename}"></audio>
     <table>
         <thead><tr><th>時間</th><th>話者</th><th>発言内容</th></tr></thead>
         <tbody>
-            {rows}
+            ${rows}
         </tbody>
     </table>
     <script>
-        function seek(seconds) {{
+        function seek(seconds) {
             const player = document.getElementById('player');
             player.currentTime = seconds;
             player.play();
-        }}
+        }
     </script>
 </body>
-</html>"""
-    return html_content
+</html>""")
+
+def generate_html_player(df, base_filename, audio_filename):
+    """HTMLプレイヤーを生成する"""
+    # 行ごとのSeries生成(iterrows)を避け、列の配列をまとめて走査する
+    time_col = format_timestamps(df['Start'].to_numpy())
+    rows = "".join(
+        f"<tr><td class='time-col'><span class='timestamp' onclick='seek({start})'>{time_formatted}</span></td><td class='speaker-col'>{speaker}</td><td>{text}</td></tr>"
+        for start, time_formatted, speaker, text in zip(
+            df['Start'].tolist(), time_col, df['Speaker'].to_numpy(), df['Text'].to_numpy()
+        )
+    )
+
+    return PLAYER_HTML_TEMPLATE.substitute(base_filename=base_filename, audio_filename=audio_filename, rows=rows)
 
 def generate_summary_text(df):
     """調書用・結合テキストを生成する"""
-    text_content = ""
-    current_speaker = None
+    # 同じ話者が連続する行を1つのまとまり(run)として結合する
+    speakers = df['Speaker']
+    run_ids = speakers.ne(speakers.shift()).cumsum()
+    run_speakers = speakers.groupby(run_ids, sort=False).first()
+    run_texts = df['Text'].astype(str).groupby(run_ids, sort=False).agg("".join)
     
-    for _, row in df.iterrows():
-        speaker = row['Speaker']
-        text = row['Text']
-        
-        if speaker != current_speaker:
-            text_content += f"\n【{speaker}】\n{text}"
-            current_speaker = speaker
-        else:
-            text_content += f"{text}"
-            
-    return text_content.strip()
+    buffer = io.StringIO()
+    for speaker, text in zip(run_speakers, run_texts):
+        buffer.write(f"\n【{speaker}】\n{text}")
+    return buffer.getvalue().strip()
 
 def generate_raw_text(df):
     """調書用・原文テキストを生成する"""
-    return "\n".join(df['Text'].tolist())
+    # pandasの文字列結合で処理する（空欄のセルは空行として扱う）
+    return df['Text'].str.cat(sep="\n", na_rep="")
+
+def open_zip_text(zf, name, encoding="utf-8"):
+    """ZIP内のエントリをテキストストリームとして開く（encode()+writestrによる全文コピーを避ける）"""
+    # 書き込み前にサイズが分からないため、大きなエントリにも対応できるようZIP64を有効にする
+    zs = zf.open(name, "w", force_zip64=True)
+    return io.TextIOWrapper(zs, encoding=encoding, newline="")
 
 def create_output_zip(df, base_filename, audio_filename):
     """
@@ -223,28 +595,147 @@ def create_output_zip(df, base_filename, audio_filename):
     HTML, Summary, Raw, (必要ならCSV) を含むZIPバイナリを作成して返す関数
     """
     base_name = os.path.splitext(base_filename)[0]
-    zip_buffer = io.BytesIO()
+    # 小さいZIPはメモリ上、ZIP_SPOOL_MAX_SIZEを超えるものはディスクに退避して組み立てる
+    zip_buffer = tempfile.SpooledTemporaryFile(max_size=ZIP_SPOOL_MAX_SIZE, dir=TEMP_DIR)
     
-    with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED) as zf:
-        # 1. CSV
-        csv_data = df.to_csv(index=False).encode('utf-8-sig')
-        zf.writestr(f"{base_name}.csv", csv_data)
+    # テキストは圧縮が効きやすいため、最速の圧縮レベルで十分
+    with zip_buffer, zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED, compresslevel=1) as zf:
+        # 1. CSV (Excel向けにBOM付き。エントリへ直接書き出す)
+        with open_zip_text(zf, f"{base_name}.csv", "utf-8-sig") as f:
+            df.to_csv(f, index=False)
         
         # 2. HTML Player
-        html_content = generate_html_player(df, base_filename, audio_filename)
-        zf.writestr(f"{base_name}_player.html", html_content.encode('utf-8'))
+        with open_zip_text(zf, f"{base_name}_player.html") as f:
+            f.write(generate_html_player(df, base_filename, audio_filename))
         
         # 3. Summary Text
-        summary_content = generate_summary_text(df)
-        zf.writestr(f"{base_name}_summary.txt", summary_content.encode('utf-8'))
+        with open_zip_text(zf, f"{base_name}_summary.txt") as f:
+            f.write(generate_summary_text(df))
         
         # 4. Raw Text
-        raw_content = generate_raw_text(df)
-        zf.writestr(f"{base_name}_raw.txt", raw_content.encode('utf-8'))
+        with open_zip_text(zf, f"{base_name}_raw.txt") as f:
+            f.write(generate_raw_text(df))
         
-    return zip_buffer.getvalue(), f"{base_name}_files.zip"
+        # st.download_buttonはbytesを要求するため、完成したZIPを1回だけ読み出す
+        zf.close()
+        zip_buffer.seek(0)
+        zip_data = zip_buffer.read()
+        
+    return zip_data, f"{base_name}_files.zip"
 
-def cleanup_temp_files(file_patterns):
+# タブ2のCSV・ZIPを保持する件数 (アップロードごとにサーバーのメモリへ溜まり続けないように)
+UPLOAD_CACHE_MAX_ENTRIES = 4
+
+@st.cache_data(show_spinner=False, max_entries=UPLOAD_CACHE_MAX_ENTRIES)
+def parse_uploaded_csv(raw_bytes):
+    """アップロードされたCSVを読み込む（同じ内容なら再解析しない）"""
+    return pd.read_csv(io.BytesIO(raw_bytes))
+
+@st.cache_data(show_spinner=False, max_entries=UPLOAD_CACHE_MAX_ENTRIES)
+def build_output_zip(raw_bytes, base_filename, audio_filename):
+    """アップロードされたCSVからZIPを生成する（同じ内容・ファイル名なら再生成しない）
+    ※DataFrameをキーにすると大きな表は一部の行しかハッシュされず、修正後も古いZIPが返るため、CSVのバイト列をキーにする"""
+    return create_output_zip(parse_uploaded_csv(raw_bytes), base_filename, audio_filename)
+
+def list_audio_files(folder_path):
+    """フォルダ内の音声ファイルを列挙する（フォルダが更新されていなければ再走査しない）"""
+    scan_key = (folder_path, os.stat(folder_path).st_mtime_ns)
+    cached = st.session_state.get("audio_file_scan")
+    if cached and cached[0] == scan_key:
+        return cached[1]
+    
+    # scandirはディレクトリエントリの種別を持っているため、エントリごとのstatが不要
+    with os.scandir(folder_path) as entries:
+        audio_files = [
+            entry.path for entry in entries
+            if entry.is_file() and entry.name.lower().endswith(('.mp3', '.wav', '.m4a'))
+        ]
+    st.session_state["audio_file_scan"] = (scan_key, audio_files)
+    return audio_files
+
+def get_file_hash(file_path):
+    """音声ファイルの内容ハッシュを返す（ファイルが更新されていなければ再計算しない）"""
+    return compute_file_hash(file_path, os.stat(file_path).st_mtime_ns)
+
+@st.cache_data(show_spinner=False)
+def compute_file_hash(file_path, mtime_ns):
+    """ファイル内容のハッシュ値を計算する
+    ※mtime_nsはキャッシュキー用（ファイル更新時に再計算させる）"""
+    h = blake3.blake3() if blake3 else hashlib.blake2b()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            h.update(chunk)
+    return h.hexdigest()[:16]
+
+def make_cache_key(*params):
+    """処理条件（プロンプト・話者数など）からキャッシュキーを作る"""
+    return hashlib.md5(repr(params).encode("utf-8")).hexdigest()[:8]
+
+def get_cache_dir(file_path):
+    """音声ファイルごとのキャッシュフォルダ（作成は save_to_cache で書き込む時に行う）"""
+    return os.path.join(CACHE_DIR, get_file_hash(file_path))
+
+def restore_from_cache(cache_path, dest_path):
+    """キャッシュがあれば処理結果の保存先へコピーし、Trueを返す"""
+    if not os.path.exists(cache_path):
+        return False
+    shutil.copyfile(cache_path, dest_path)
+    return True
+
+def save_to_cache(src_path, cache_path):
+    """処理結果をキャッシュへ保存する"""
+    if os.path.exists(src_path):
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        shutil.copyfile(src_path, cache_path)
+
+def remove_expired_cache():
+    """保存期間を過ぎたキャッシュフォルダを削除する"""
+    if not os.path.isdir(CACHE_DIR):
+        return
+    expire_before = time.time() - CACHE_RETENTION_DAYS * 24 * 60 * 60
+    with os.scandir(CACHE_DIR) as entries:
+        for entry in entries:
+            try:
+                if entry.is_dir() and entry.stat().st_mtime < expire_before:
+                    shutil.rmtree(entry.path)
+            except Exception as e:
+                print(f"Error deleting {entry.path}: {e}")
+
+def clear_cache():
+    """保存済みのキャッシュをすべて削除する"""
+    shutil.rmtree(CACHE_DIR, ignore_errors=True)
+
+def read_result_csv(csv_path):
+    """
+    step3_merge.py の結果CSVを読み込む。
+    pyarrowで書き出したCSVは整数値の時刻を "1" のように書くため、Start/End は常に小数として読む
+    """
+    return pd.read_csv(csv_path, dtype={"Start": "float64", "End": "float64"})
+
+def show_results(df, target_file_path, cleanup_files, title="📝 解析結果"):
+    """解析結果の表示・ZIPダウンロード・一時ファイルの削除を行う"""
+    st.subheader(title)
+    st.dataframe(df.head(10))
+    
+    # ZIP Download
+    zip_data, zip_name = create_output_zip(df, os.path.basename(target_file_path), os.path.basename(target_file_path))
+    st.download_button(
+        label="📥 結果ファイルを一括ダウンロード (ZIP)",
+        data=zip_data,
+        file_name=zip_name,
+        mime="application/zip",
+        help=f"ダウンロード後、サーバー上の一時ファイルは削除されます。ただし、サイドバーで処理結果のキャッシュを有効にしている場合は、処理結果が {CACHE_DIR} に最大{CACHE_RETENTION_DAYS}日間保存されます。"
+    )
+    
+    # Also delete uploaded file if it's in temp
+    cleanup_files = list(cleanup_files)
+    if target_file_path.startswith(TEMP_DIR):
+        cleanup_files.append(target_file_path)
+    
+    cleanup_temp_files(cleanup_files)
+    st.info("🗑️ 一時ファイルの削除を開始しました。")
+
+def remove_temp_files(file_patterns):
     """一時ファイルを削除する"""
     for pattern in file_patterns:
         for f in glob.glob(pattern):
@@ -253,6 +744,15 @@ def cleanup_temp_files(file_patterns):
                 # st.write(f"Deleted: {f}") # Debug
             except Exception as e:
                 print(f"Error deleting {f}: {e}")
+
+@st.cache_resource
+def get_cleanup_executor():
+    """一時ファイル削除用のバックグラウンドスレッド（再実行を跨いで1つだけ保持する）"""
+    return ThreadPoolExecutor(max_workers=1, thread_name_prefix="temp-cleanup")
+
+def cleanup_temp_files(file_patterns):
+    """一時ファイルの削除をバックグラウンドで実行する（UIの応答を待たせない）"""
+    get_cleanup_executor().submit(remove_temp_files, list(file_patterns))
 # ==========================================
 # Main GUI
 # ==========================================
@@ -266,6 +766,25 @@ with st.sidebar:
     hf_token = st.text_input("Hugging Face Token", type="password", help="Pyannoteのモデル利用に必要です")
     if not hf_token:
         st.warning("⚠️ Diarizationを実行するにはトークンが必要です")
+    
+    use_cache = st.checkbox(
+        "処理結果をキャッシュする",
+        help=f"同じ音声・同じ条件の処理結果を {CACHE_DIR} に保存し、再実行時に再利用します。保存した結果は{CACHE_RETENTION_DAYS}日後に自動で削除されます。音声の内容（文字起こし結果）がサーバーに残るため、必要な場合のみ有効にしてください。"
+    )
+    refresh_cache = False
+    if use_cache:
+        refresh_cache = st.checkbox(
+            "キャッシュを使わずに再処理する",
+            help="チェックすると保存済みの結果を無視して処理し直します（新しい結果はキャッシュに保存されます）。"
+        )
+    if st.button("🗑️ キャッシュを削除", help=f"{CACHE_DIR} に保存された処理結果をすべて削除します。"):
+        clear_cache()
+        st.success("キャッシュを削除しました。")
+    
+    # 保存期間を過ぎたキャッシュはバックグラウンドで削除する
+    get_cleanup_executor().submit(remove_expired_cache)
+    # キャッシュから読み込むかどうか（無効時は読み込みも保存もしない）
+    read_cache = use_cache and not refresh_cache
 
 # --- Input Method Selection ---
 tab1, tab2 = st.tabs(["🎙️ 新規書き起こし", "📝 修正CSVから出力作成"])
@@ -280,16 +799,23 @@ with tab1:
         if uploaded_file is not None:
             # 1. ファイルの一時保存
             raw_path = os.path.join(TEMP_DIR, uploaded_file.name)
-            with open(raw_path, "wb") as f:
-                f.write(uploaded_file.getbuffer())
+            # 再実行のたびに書き直すとmtimeが変わり、ffprobe・ハッシュのキャッシュが効かなくなるため、
+            # 同じアップロードが保存済みならそのまま使う
+            saved_upload = (uploaded_file.file_id, uploaded_file.size, raw_path)
+            if (st.session_state.get("saved_upload") != saved_upload
+                    or not os.path.exists(raw_path) or os.path.getsize(raw_path) != uploaded_file.size):
+                # 4MiBずつコピーし、大きな音声ファイルでもメモリ使用量を抑える
+                uploaded_file.seek(0)
+                with open(raw_path, "wb") as f:
+                    shutil.copyfileobj(uploaded_file, f, length=UPLOAD_COPY_CHUNK_SIZE)
+                st.session_state["saved_upload"] = saved_upload
             st.info(f"ファイルを受け取りました: {uploaded_file.name}")
             target_file_path = raw_path
     
     elif input_method.startswith("ローカルフォルダ選択"):
         folder_path = st.text_input("フォルダパスを入力", value=os.getcwd())
         if os.path.isdir(folder_path):
-            files = glob.glob(os.path.join(folder_path, "*"))
-            audio_files = [f for f in files if f.lower().endswith(('.mp3', '.wav', '.m4a'))]
+            audio_files = list_audio_files(folder_path)
             if audio_files:
                 selected_filename = st.selectbox("ファイルを選択", [os.path.basename(f) for f in audio_files])
                 target_file_path = os.path.join(folder_path, selected_filename)
@@ -302,6 +828,9 @@ with tab1:
     # --- Detailed Settings (Legal Prompt & Options) ---
     user_keywords = ""
     force_stereo_split = False
+    transcribe_workers = 2
+    batched_transcribe = False
+    embedding_backend = "PyTorch (標準)"
     
     if target_file_path:
         with st.expander("詳細設定（固有名詞・処理オプション）", expanded=False):
@@ -324,6 +853,23 @@ with tab1:
                 "2チャネル(ステレオ)を強制的に分離して処理する",
                 help="ステレオ音源を左右チャネルに分離して個別に処理します。"
             )
+            
+            transcribe_workers = st.number_input(
+                "チャネル分離時の文字起こし並列数",
+                min_value=1, max_value=MAX_RESIDENT_WORKERS, value=2,
+                help="複数チャネルを同時に文字起こしします。GPUのVRAMが不足する場合は1にしてください。"
+            )
+            
+            batched_transcribe = st.checkbox(
+                "バッチ推論で文字起こしを高速化する",
+                help="VADで検出した発話区間をまとめてGPUで推論します。長時間の音声ほど効果があります。"
+            )
+            
+            embedding_backend = st.selectbox(
+                "話者分離の埋め込みモデルの実行方式",
+                list(EMBEDDING_BACKENDS),
+                help="ONNX Runtimeを使う場合は、事前に scripts/export_embedding_onnx.py でモデルを書き出しておく必要があります。int8はCPU実行時に効果があります。"
+            )
     
     # Refactoring UI flow to allow mode selection BEFORE processing
     if target_file_path:
@@ -367,40 +913,66 @@ with tab1:
     
                 if process_mode == "mono":
                     # --- Case B: Mono / Stereo Mix ---
-                    status_area.text("⏳ Step 0/3: 前処理中 (ノイズ除去 & WAV変換)...")
-                    clean_wav_path = convert_and_denoise(target_file_path)
+                    num_speakers = None
+                    # 話者数が指定されている場合、ジョブに追加
+                    if speaker_count_option != "自動判定":
+                        # "2人（尋問・対談）" -> 2, "10人" -> 10
+                        # "人"で分割して数値を取り出す
+                        num_str = speaker_count_option.split("人")[0]
+                        num_speakers = int(num_str)
                     
-                    if clean_wav_path:
-                        progress_bar.progress(20)
+                    # キャッシュは工程ごとに分ける（プロンプトを変えてもWhisperだけ再実行すればよい）
+                    # ※音声全体のハッシュ計算が必要なため、キャッシュが有効な場合のみ保存先を求める
+                    cached_json = cached_rttm = cached_csv = None
+                    if use_cache:
+                        cache_dir = get_cache_dir(target_file_path)
+                        transcribe_key = make_cache_key(initial_prompt, batched_transcribe)
+                        diarize_key = make_cache_key(num_speakers, embedding_backend)
+                        cached_json = os.path.join(cache_dir, f"whisper_{transcribe_key}.json")
+                        cached_rttm = os.path.join(cache_dir, f"diarize_{diarize_key}.rttm")
+                        cached_csv = os.path.join(cache_dir, f"final_{transcribe_key}_{diarize_key}.csv")
                         
-                        # Step 1: Transcribe
-                        status_area.text("⏳ Step 1/3: 文字起こしを実行中 (Whisper - GPU)...")
-                        cmd_transcribe = [
-                            WHISPER_PYTHON_PATH, SCRIPT_TRANSCRIBE,
-                            "--input", clean_wav_path,
-                            "--prompt", initial_prompt
-                        ]
-                        if run_command(cmd_transcribe, "Whisper文字起こし"):
-                            progress_bar.progress(50)
+                    if read_cache and os.path.exists(cached_csv):
+                        # 同じ音声・同じ条件の結果があれば、前処理から統合までを省略する
+                        progress_bar.progress(100)
+                        status_area.success("✅ 完了しました！（キャッシュ済みの結果を使用）")
+                        show_results(read_result_csv(cached_csv), target_file_path, [])
+                    else:
+                        status_area.text("⏳ Step 0/3: 前処理中 (ノイズ除去 & WAV変換)...")
+                        clean_files = convert_split_denoise(target_file_path, 1, status_area)
                             
-                            # Step 2: Diarize
-                            status_area.text("⏳ Step 2/3: 話者分離を実行中 (Pyannote)...")
-                            cmd_diarize = [
-                                PYANNOTE_PYTHON_PATH, SCRIPT_DIARIZE,
-                                "--input", clean_wav_path
-                            ]
+                        if clean_files:
+                            clean_wav_path = clean_files[0]
+                            json_path = str(Path(clean_wav_path).with_suffix(".json"))
+                            rttm_path = str(Path(clean_wav_path).with_suffix(".rttm"))
+                            progress_bar.progress(20)
                             
-                            # 話者数が指定されている場合、引数を追加
-                            if speaker_count_option != "自動判定":
-                                # "2人（尋問・対談）" -> 2, "10人" -> 10
-                                # "人"で分割して数値を取り出す
-                                num_str = speaker_count_option.split("人")[0]
-                                num_speakers = int(num_str)
-                                cmd_diarize.extend(["--num_speakers", str(num_speakers)])
+                            # Step 1 & 2: 文字起こしと話者分離は互いに依存しないため同時に実行する
+                            # (キャッシュ済みの工程は結果をコピーして省略する)
+                            status_area.text("⏳ Step 1-2/3: 文字起こし (Whisper) と話者分離 (Pyannote) を実行中...")
+                            tasks = []
+                            workers_ready = True
+                            if read_cache and restore_from_cache(cached_json, json_path):
+                                st.info("♻️ 文字起こし: キャッシュ済みの結果を使用します。")
+                            else:
+                                whisper_worker = get_whisper_worker()
+                                transcribe_job = build_transcribe_job(clean_wav_path, initial_prompt, batched_transcribe)
+                                tasks.append((whisper_worker, transcribe_job, "Whisper文字起こし"))
+                                workers_ready = workers_ready and whisper_worker is not None
     
-                            env_vars = {"HF_TOKEN": hf_token}
+                            if read_cache and restore_from_cache(cached_rttm, rttm_path):
+                                st.info("♻️ 話者分離: キャッシュ済みの結果を使用します。")
+                            else:
+                                diarize_job = {"input": clean_wav_path, "num_speakers": num_speakers}
+                                # HF_TOKENはワーカー起動時に環境変数として渡す
+                                pyannote_worker = get_pyannote_worker(hf_token, embedding_backend)
+                                tasks.append((pyannote_worker, diarize_job, "Pyannote話者分離"))
+                                workers_ready = workers_ready and pyannote_worker is not None
                             
-                            if run_command(cmd_diarize, "Pyannote話者分離", env=env_vars):
+                            if workers_ready and (not tasks or run_worker_jobs(tasks, status_area, progress_bar, 20, 80)):
+                                if use_cache:
+                                    save_to_cache(json_path, cached_json)
+                                    save_to_cache(rttm_path, cached_rttm)
                                 progress_bar.progress(80)
                                 
                                 # Step 3: Merge
@@ -409,121 +981,94 @@ with tab1:
                                     PYANNOTE_PYTHON_PATH, SCRIPT_MERGE,
                                     "--input_wav", clean_wav_path
                                 ]
-                                if run_command(cmd_merge, "データ統合"):
+                                if run_command(cmd_merge, "データ統合", status_area=status_area):
                                     progress_bar.progress(100)
                                     status_area.success("✅ 完了しました！")
                                     
                                     # Result
-                                    csv_path = clean_wav_path.replace(".wav", "_final.csv")
+                                    csv_path = str(Path(clean_wav_path).with_name(f"{Path(clean_wav_path).stem}_final.csv"))
                                     if os.path.exists(csv_path):
-                                        df = pd.read_csv(csv_path)
-                                        st.subheader("📝 解析結果")
-                                        st.dataframe(df.head(10))
-                                        
-                                        # ZIP Download
-                                        zip_data, zip_name = create_output_zip(df, os.path.basename(target_file_path), os.path.basename(target_file_path))
-                                        st.download_button(
-                                            label="📥 結果ファイルを一括ダウンロード (ZIP)",
-                                            data=zip_data,
-                                            file_name=zip_name,
-                                            mime="application/zip",
-                                            help="ダウンロード後、サーバー上の一時ファイルはすべて削除されます。"
-                                        )
+                                        if use_cache:
+                                            save_to_cache(csv_path, cached_csv)
                                         
                                         # Cleanup
                                         cleanup_files = [
                                             clean_wav_path,
-                                            clean_wav_path.replace(".wav", ".json"),
-                                            clean_wav_path.replace(".wav", ".rttm"),
+                                            json_path,
+                                            rttm_path,
                                             csv_path
                                         ]
-                                        # Also delete uploaded file if it's in temp
-                                        if target_file_path.startswith(TEMP_DIR):
-                                            cleanup_files.append(target_file_path)
-                                            
-                                        cleanup_temp_files(cleanup_files)
-                                        status_area.info("🗑️ 一時ファイルを削除しました。")
+                                        show_results(read_result_csv(csv_path), target_file_path, cleanup_files)
     
                 elif process_mode == "multi":
                     # --- Case A: Multi-channel Split ---
-                    status_area.text("⏳ Step 0/3: チャネル分割中...")
+                    cached_csv = None
+                    if use_cache:
+                        cached_csv = os.path.join(
+                            get_cache_dir(target_file_path),
+                            f"final_multi_{make_cache_key(channels, initial_prompt, batched_transcribe)}.csv"
+                        )
                     
-                    # 1. Split Channels
-                    channel_files = split_channels(target_file_path, channels)
-                    if not channel_files:
-                        st.error("チャネル分割に失敗しました。")
+                    if read_cache and os.path.exists(cached_csv):
+                        # 同じ音声・同じ条件の結果があれば、前処理から統合までを省略する
+                        progress_bar.progress(100)
+                        status_area.success("✅ 完了しました！（キャッシュ済みの結果を使用）")
+                        show_results(read_result_csv(cached_csv), target_file_path, [], "📝 解析結果 (マルチチャネル統合)")
                     else:
-                        progress_bar.progress(20)
+                        status_area.text("⏳ Step 0/3: 前処理中 (ノイズ除去 & チャネル分割)...")
                         
-                        # 2. Transcribe Each Channel
-                        status_area.text("⏳ Step 1/2: 各チャネルを文字起こし中 (Whisper)...")
-                        
-                        # Process sequentially (could be parallelized but GPU VRAM might be an issue)
-                        for i, ch_file in enumerate(channel_files):
-                            status_area.text(f"⏳ 文字起こし中: Channel {i+1}/{len(channel_files)}...")
-                            cmd_transcribe = [
-                                WHISPER_PYTHON_PATH, SCRIPT_TRANSCRIBE,
-                                "--input", ch_file,
-                                "--prompt", initial_prompt
-                            ]
-                            if not run_command(cmd_transcribe, f"Whisper (Ch {i+1})"):
-                                st.error(f"Channel {i+1} の処理中にエラーが発生しました。")
-                                break
+                        # 1. Denoise & Split Channels
+                        channel_files = convert_split_denoise(target_file_path, channels, status_area)
+                        if not channel_files:
+                            st.error("チャネル分割に失敗しました。")
                         else:
-                            # All channels processed successfully
-                            progress_bar.progress(70)
-                            
-                            # 3. Merge (New Logic)
-                            status_area.text("⏳ Step 2/2: 全チャネルのデータを統合中...")
+                            progress_bar.progress(20)
+                        
+                            # 2. Transcribe Each Channel
+                            status_area.text("⏳ Step 1/2: 各チャネルを文字起こし中 (Whisper)...")
                             
-                            # We will use the first channel file as the "primary" input for the script to locate others?
-                            # Or just pass the list of wavs (which have associated jsons).
+                            workers = min(len(channel_files), int(transcribe_workers))
+                            if transcribe_channels(channel_files, initial_prompt, batched_transcribe, workers, status_area, progress_bar):
+                                # All channels processed successfully
+                                progress_bar.progress(70)
                             
-                            # Let's construct a command that passes all wav files
-                            cmd_merge = [
-                                PYANNOTE_PYTHON_PATH, SCRIPT_MERGE,
-                                "--multi_mode",
-                                "--input_wavs"
-                            ] + channel_files
+                                # 3. Merge (New Logic)
+                                status_area.text("⏳ Step 2/2: 全チャネルのデータを統合中...")
                             
-                            # We need to define the output path.
-                            output_csv = os.path.join(TEMP_DIR, f"{Path(target_file_path).stem}_final.csv")
+                                # Each channel is one speaker by construction, so Pyannote diarization is skipped
+                                # entirely: the merge script labels each channel's JSON with a fixed speaker.
+                                channel_speakers = [f"SPEAKER_CH{i+1}" for i in range(len(channel_files))]
+                                cmd_merge = [
+                                    PYANNOTE_PYTHON_PATH, SCRIPT_MERGE,
+                                    "--multi_mode",
+                                    "--input_wavs"
+                                ] + channel_files + ["--channel_speakers"] + channel_speakers
+                                # チャネル数が多い場合はJSONの読み込みを並列化する
+                                if len(channel_files) >= 3:
+                                    cmd_merge.append("--parallel")
                             
-                            cmd_merge.extend(["--output", output_csv])
+                                # We need to define the output path.
+                                output_csv = os.path.join(TEMP_DIR, f"{Path(target_file_path).stem}_final.csv")
                             
-                            if run_command(cmd_merge, "データ統合 (Multi)"):
-                                progress_bar.progress(100)
-                                status_area.success("✅ 完了しました！")
+                                cmd_merge.extend(["--output", output_csv])
                                 
-                                if os.path.exists(output_csv):
-                                    df = pd.read_csv(output_csv)
-                                    st.subheader("📝 解析結果 (マルチチャネル統合)")
-                                    st.dataframe(df.head(10))
+                                if run_command(cmd_merge, "データ統合 (Multi)", status_area=status_area):
+                                    progress_bar.progress(100)
+                                    status_area.success("✅ 完了しました！")
                                     
-                                    # ZIP Download
-                                    zip_data, zip_name = create_output_zip(df, os.path.basename(target_file_path), os.path.basename(target_file_path))
-                                    st.download_button(
-                                        label="📥 結果ファイルを一括ダウンロード (ZIP)",
-                                        data=zip_data,
-                                        file_name=zip_name,
-                                        mime="application/zip",
-                                        help="ダウンロード後、サーバー上の一時ファイルはすべて削除されます。"
-                                    )
+                                    if os.path.exists(output_csv):
+                                        if use_cache:
+                                            save_to_cache(output_csv, cached_csv)
                                     
-                                    # Cleanup
-                                    cleanup_files = [output_csv]
-                                    for ch_file in channel_files:
-                                        cleanup_files.append(ch_file)
-                                        cleanup_files.append(ch_file.replace(".wav", ".json"))
+                                        # Cleanup
+                                        cleanup_files = [output_csv]
+                                        for ch_file in channel_files:
+                                            cleanup_files.append(ch_file)
+                                            cleanup_files.append(str(Path(ch_file).with_suffix(".json")))
                                         
-                                    # Also delete uploaded file if it's in temp
-                                    if target_file_path.startswith(TEMP_DIR):
-                                        cleanup_files.append(target_file_path)
-    
-                                    cleanup_temp_files(cleanup_files)
-                                    status_area.info("🗑️ 一時ファイルを削除しました。")
-                                else:
-                                    st.error("結果ファイルが生成されませんでした。")
+                                        show_results(read_result_csv(output_csv), target_file_path, cleanup_files, "📝 解析結果 (マルチチャネル統合)")
+                                    else:
+                                        st.error("結果ファイルが生成されませんでした。")
 
 with tab2:
     st.header("修正済みCSVから各フォーマットを生成")
@@ -536,7 +1081,8 @@ with tab2:
         if st.button("フォーマット変換・ZIP作成"):
             try:
                 # CSV読み込み
-                df_fixed = pd.read_csv(uploaded_csv)
+                raw_csv = uploaded_csv.getvalue()
+                df_fixed = parse_uploaded_csv(raw_csv)
                 
                 # 必須カラムチェック
                 required_cols = ["Start", "End", "Speaker", "Text"]
@@ -546,7 +1092,7 @@ with tab2:
                     # 共通関数でZIP生成
                     # base_filenameはCSVファイル名から拡張子を除いたもの
                     base_name = os.path.splitext(uploaded_csv.name)[0]
-                    zip_data, zip_name = create_output_zip(df_fixed, base_name, audio_name)
+                    zip_data, zip_name = build_output_zip(raw_csv, base_name, audio_name)
                     
                     st.success("生成完了！")
                     st.download_button(
@@ -0,0 +1,60 @@
+import argparse
+import os
+import sys
+import torch
+from onnxruntime.quantization import quantize_dynamic, QuantType
+
+# Reuse the pipeline loading (HF_TOKEN / .env handling) from Step 2
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from step2_diarize import load_pipeline
+
+class ResNetFrames(torch.nn.Module):
+    """Convolutional trunk of the WeSpeaker ResNet (fbank -> frame-wise features)"""
+
+    def __init__(self, resnet):
+        super().__init__()
+        self.resnet = resnet
+
+    def forward(self, fbank):
+        return self.resnet.forward_frames(fbank)
+
+def export(output_file, quantized_file):
+    # Export the original FP32 model (without the FP16 autocast wrapper)
+    pipeline = load_pipeline(fp16=False)
+
+    # Embedding model of speaker-diarization-3.1 (WeSpeaker ResNet34)
+    model = pipeline._embedding.model_.to(torch.device("cpu")).eval()
+
+    # Dummy input: fbank features of 10s of audio, (batch, frames, features)
+    waveforms = torch.randn(1, 1, 16000 * 10)
+    with torch.no_grad():
+        fbank = model.compute_fbank(waveforms)
+
+    os.makedirs(os.path.dirname(output_file) or ".", exist_ok=True)
+
+    # Only the convolutional trunk is exported: stats pooling (with the speaker
+    # weights) and the final linear layer stay in PyTorch and are cheap
+    print(f"Exporting embedding model to {output_file}...")
+    torch.onnx.export(
+        ResNetFrames(model.resnet),
+        (fbank,),
+        output_file,
+        input_names=["fbank"],
+        output_names=["frames"],
+        dynamic_axes={"fbank": {0: "batch", 1: "num_frames"}, "frames": {0: "batch", 3: "num_embedding_frames"}},
+        opset_version=17,
+        dynamo=False
+    )
+
+    # FP32 -> INT8 dynamic quantization of the weights
+    print(f"Quantizing weights to int8: {quantized_file}...")
+    quantize_dynamic(output_file, quantized_file, weight_type=QuantType.QInt8)
+    print("Export finished.")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export Pyannote's speaker-embedding model to ONNX (int8)")
+    parser.add_argument("--output", default="models/embedding.onnx", help="Path to the FP32 ONNX model")
+    parser.add_argument("--quantized_output", default="models/embedding.int8.onnx", help="Path to the int8 quantized ONNX model")
+    args = parser.parse_args()
+
+    export(args.output, args.quantized_output)
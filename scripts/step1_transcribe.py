@@ -1,29 +1,70 @@
 import argparse
 import json
 import os
-import whisper
-import torch
+import sys
+from pathlib import Path
+import ctranslate2
+from faster_whisper import WhisperModel, BatchedInferencePipeline
 
-def transcribe(input_file, initial_prompt=None):
-    print(f"Loading OpenAI Whisper model for {input_file}...")
+# Prefer orjson for writing large word-timestamp JSON (falls back to stdlib json)
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+MODEL_SIZE = "large-v2" # Stable version
+
+def torch_gpu_available():
+    """True if PyTorch sees a GPU (the ROCm build reports AMD GPUs through torch.cuda)"""
+    try:
+        import torch
+    except ImportError:
+        return False
+    return torch.cuda.is_available()
+
+def load_openai_whisper_model():
+    """
+    Fallback for GPUs that CTranslate2 cannot use: the PyPI ctranslate2 wheels are CUDA-only,
+    so on AMD GPUs (ROCm) run the reference openai-whisper implementation on the GPU instead
+    of dropping to CPU int8.
+    """
+    import torch
+    import whisper
     
-    # Check for ROCm (HIP)
-    if torch.cuda.is_available():
-        print(f"CUDA (ROCm) is available: {torch.cuda.get_device_name(0)}")
+    print(f"CUDA (ROCm) is available for PyTorch: {torch.cuda.get_device_name(0)}")
+    print("CTranslate2 cannot use this GPU, falling back to openai-whisper on the GPU.")
+    try:
+        return whisper.load_model(MODEL_SIZE, device="cuda")
+    except Exception as e:
+        print(f"Error loading model: {e}")
+        exit(1)
+
+def load_model(compute_type=None):
+    # Check for GPU support in the CTranslate2 build
+    if ctranslate2.get_cuda_device_count() > 0:
+        print("CUDA is available for CTranslate2.")
         device = "cuda"
+    elif torch_gpu_available():
+        return load_openai_whisper_model()
     else:
         print("CUDA is NOT available, using CPU.")
         device = "cpu"
     
-    model_size = "large-v2" # Stable version
+    print("Loading faster-whisper (CTranslate2) model...")
+    
+    # Quantized inference: FP16 on GPU, INT8 on CPU (uses AVX2/AVX-512 VNNI when available)
+    if compute_type is None:
+        compute_type = "float16" if device == "cuda" else "int8"
+    print(f"Using compute type: {compute_type}")
     
     try:
-        model = whisper.load_model(model_size, device=device)
+        return WhisperModel(MODEL_SIZE, device=device, compute_type=compute_type)
     except Exception as e:
         print(f"Error loading model: {e}")
         exit(1)
 
-    print("Starting transcription...")
+def transcribe_with_model(model, input_file, initial_prompt=None, batched=False, batch_size=8, vad=True):
+    print(f"Starting transcription for {input_file}...")
     
     # Prepare transcription parameters (Strict mode to prevent hallucinations)
     transcribe_params = {
@@ -39,40 +80,144 @@ def transcribe(input_file, initial_prompt=None):
         print(f"Using initial prompt: {initial_prompt}")
         transcribe_params["initial_prompt"] = initial_prompt
     
-    result = model.transcribe(input_file, **transcribe_params)
+    if isinstance(model, WhisperModel):
+        results = run_faster_whisper(model, input_file, transcribe_params, batched, batch_size, vad)
+    else:
+        # openai-whisper (ROCm fallback) has neither batched inference nor a VAD filter
+        results = run_openai_whisper(model, input_file, transcribe_params)
+    
+    # Save to JSON
+    output_file = str(Path(input_file).with_suffix(".json"))
+    if orjson is not None:
+        with open(output_file, "wb") as f:
+            f.write(orjson.dumps(results, option=orjson.OPT_INDENT_2))
+    else:
+        with open(output_file, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+    
+    print(f"Transcription saved to {output_file}")
+    return output_file
 
-    segments = result["segments"]
+def run_faster_whisper(model, input_file, transcribe_params, batched, batch_size, vad):
+    # Batched mode: split the audio into VAD speech chunks and decode them
+    # batch_size at a time in a single forward pass to keep the GPU busy
+    if batched:
+        print(f"Using batched inference (batch_size={batch_size}, VAD enabled)")
+        model = BatchedInferencePipeline(model=model)
+        transcribe_params["batch_size"] = batch_size
+        transcribe_params["vad_filter"] = True
+    elif vad:
+        # Silence admission filter: Silero VAD drops silent regions (>= 1s) before the encoder runs.
+        # Segment/word timestamps are mapped back to the original timeline by faster-whisper.
+        print("Using VAD filter to skip silent regions")
+        transcribe_params["vad_filter"] = True
+        transcribe_params["vad_parameters"] = {"min_silence_duration_ms": 1000}
+    
+    # segments is a generator: decoding runs while we iterate over it
+    segments, info = model.transcribe(input_file, **transcribe_params)
+    print(f"Audio duration: {info.duration:.2f}s")
+    
     results = []
     for segment in segments:
-        print(f"[{segment['start']:.2f}s -> {segment['end']:.2f}s] {segment['text']}")
+        print(f"[{segment.start:.2f}s -> {segment.end:.2f}s] {segment.text}")
         
-        # Extract word-level info if available
+        # Extract word-level info if available (same keys as openai-whisper).
+        # faster-whisper returns numpy.float64 here, which orjson refuses to serialize
         words = []
-        if "words" in segment:
-            words = segment["words"]
-            
+        if segment.words:
+            words = [
+                {"word": w.word, "start": float(w.start), "end": float(w.end), "probability": float(w.probability)}
+                for w in segment.words
+            ]
+        
         results.append({
-            "start": segment['start'],
-            "end": segment['end'],
-            "text": segment['text'],
+            "start": float(segment.start),
+            "end": float(segment.end),
+            "text": segment.text,
             "words": words
         })
+    return results
 
-    # Save to JSON
-    output_file = input_file.replace(".wav", ".json")
-    with open(output_file, "w", encoding="utf-8") as f:
-        json.dump(results, f, ensure_ascii=False, indent=2)
+def run_openai_whisper(model, input_file, transcribe_params):
+    result = model.transcribe(input_file, **transcribe_params)
     
-    print(f"Transcription saved to {output_file}")
+    results = []
+    for segment in result["segments"]:
+        print(f"[{segment['start']:.2f}s -> {segment['end']:.2f}s] {segment['text']}")
+        
+        words = [
+            {"word": w["word"], "start": float(w["start"]), "end": float(w["end"]), "probability": float(w["probability"])}
+            for w in segment.get("words", [])
+        ]
+        
+        results.append({
+            "start": float(segment["start"]),
+            "end": float(segment["end"]),
+            "text": segment["text"],
+            "words": words
+        })
+    return results
+
+def transcribe(input_file, initial_prompt=None, compute_type=None, batched=False, batch_size=8, vad=True):
+    model = load_model(compute_type)
+    transcribe_with_model(model, input_file, initial_prompt, batched, batch_size, vad)
+
+def serve(compute_type=None):
+    """
+    Persistent worker mode: load the model once, then process jobs read from stdin.
+    Request (one JSON per line):  {"input": path, "prompt": str, "batched": bool, "batch_size": int, "vad": bool}
+    Response (one JSON per line): {"ok": true, "output": json_path} / {"ok": false, "error": message}
+    """
+    # stdout is reserved for responses: keep a private copy of fd 1 for them, then point
+    # fd 1 itself at stderr so that native libraries and child processes writing to it
+    # cannot corrupt the protocol (sys.stdout alone only covers Python-level writes)
+    sys.stdout.flush()
+    responses = os.fdopen(os.dup(1), "w", encoding="utf-8")
+    os.dup2(2, 1)
+    sys.stdout = sys.stderr
+    
+    model = load_model(compute_type)
+    print("Worker ready.")
+    
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        try:
+            job = json.loads(line)
+            if not os.path.exists(job["input"]):
+                raise FileNotFoundError(f"File not found - {job['input']}")
+            output_file = transcribe_with_model(
+                model, job["input"], job.get("prompt"),
+                job.get("batched", False), job.get("batch_size", 8), job.get("vad", True)
+            )
+            response = {"ok": True, "output": output_file}
+        except Exception as e:
+            print(f"Error: {e}")
+            response = {"ok": False, "error": str(e)}
+        responses.write(json.dumps(response, ensure_ascii=False) + "\n")
+        responses.flush()
 
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Step 1: Transcribe audio using OpenAI Whisper")
-    parser.add_argument("--input", required=True, help="Path to input WAV file")
+    parser = argparse.ArgumentParser(description="Step 1: Transcribe audio using faster-whisper")
+    parser.add_argument("--input", help="Path to input WAV file")
     parser.add_argument("--prompt", help="Initial prompt for Whisper (legal terminology, keywords, etc.)")
+    parser.add_argument("--compute_type", help="CTranslate2 compute type (default: float16 on GPU, int8 on CPU; ignored by the openai-whisper ROCm fallback)")
+    parser.add_argument("--batched", action="store_true", help="Use batched inference over VAD segments (faster on GPU)")
+    parser.add_argument("--batch_size", type=int, default=8, help="Batch size for --batched mode (default: 8)")
+    parser.add_argument("--no_vad", action="store_true", help="Disable the VAD filter (transcribe silent regions too)")
+    parser.add_argument("--serve", action="store_true", help="Run as a persistent worker reading JSON jobs from stdin")
     args = parser.parse_args()
 
+    if args.serve:
+        serve(args.compute_type)
+        exit(0)
+
+    if not args.input:
+        print("Error: --input is required")
+        exit(1)
+
     if not os.path.exists(args.input):
         print(f"Error: File not found - {args.input}")
         exit(1)
 
-    transcribe(args.input, args.prompt)
+    transcribe(args.input, args.prompt, args.compute_type, args.batched, args.batch_size, not args.no_vad)
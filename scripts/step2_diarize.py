@@ -1,33 +1,240 @@
 import argparse
+import json
+import math
 import os
-from pyannote.audio import Pipeline
+import sys
+import types
+from pathlib import Path
+from pyannote.audio import Audio, Pipeline
+from pyannote.audio.pipelines import SpeakerDiarization
+import numpy as np
 import torch
+import torch.multiprocessing as mp
+from dotenv import load_dotenv
 
-def diarize(input_file, num_speakers=None):
-    print(f"Loading Pyannote pipeline for {input_file}...")
+# Load HF_TOKEN etc. from .env once (variables already set in the environment take precedence)
+load_dotenv(".env", override=False)
+
+# Inference only: never track gradients in this process
+torch.set_grad_enabled(False)
+
+# Written by scripts/export_embedding_onnx.py
+DEFAULT_ONNX_MODEL = "models/embedding.onnx"
+DEFAULT_QUANTIZED_ONNX_MODEL = "models/embedding.int8.onnx"
+
+# The pretrained config uses 32 for both; smaller batches are faster and avoid OOM on <=12GB GPUs
+DEFAULT_BATCH_SIZE = 8
+
+class OnnxResNet(torch.nn.Module):
+    """
+    Drop-in replacement for the WeSpeaker ResNet of the embedding model.
+    The convolutional trunk runs in ONNX Runtime (FP32 or int8, see export_embedding_onnx.py);
+    stats pooling and the final linear layer stay in PyTorch.
+    """
+
+    def __init__(self, resnet, session):
+        super().__init__()
+        self.resnet = resnet
+        self.session = session
+        self.on_cuda = "CUDAExecutionProvider" in session.get_providers()
+        # fbank shape -> frames shape (only a few shapes occur: full batches and the last one)
+        self.output_shapes = {}
+
+    def forward(self, fbank, weights=None):
+        if self.on_cuda and fbank.is_cuda:
+            frames = self.run_on_device(fbank)
+        else:
+            frames = self.session.run(None, {"fbank": fbank.detach().cpu().numpy()})[0]
+            frames = torch.from_numpy(frames).to(fbank.device)
+        return self.resnet.forward_embedding(frames, weights=weights)
+
+    def run_on_device(self, fbank):
+        """Run the CUDA EP session directly on GPU tensors (IO binding, no host round trip)"""
+        fbank = fbank.detach().contiguous()
+        device_id = fbank.device.index
+        binding = self.session.io_binding()
+        binding.bind_input("fbank", "cuda", device_id, np.float32, tuple(fbank.shape), fbank.data_ptr())
+        
+        shape = self.output_shapes.get(tuple(fbank.shape))
+        if shape is None:
+            # First batch of this shape: let ONNX Runtime allocate the output to learn its shape
+            binding.bind_output("frames", "cuda", device_id)
+            self.session.run_with_iobinding(binding)
+            frames = binding.get_outputs()[0]
+            self.output_shapes[tuple(fbank.shape)] = tuple(frames.shape())
+            return torch.from_numpy(frames.numpy()).to(fbank.device)
+        
+        # Afterwards ONNX Runtime writes straight into a tensor allocated by PyTorch
+        frames = torch.empty(shape, dtype=torch.float32, device=fbank.device)
+        binding.bind_output("frames", "cuda", device_id, np.float32, shape, frames.data_ptr())
+        self.session.run_with_iobinding(binding)
+        return frames
+
+class AutocastResNet(torch.nn.Module):
+    """
+    Runs the convolutional trunk of the WeSpeaker ResNet under fp16 autocast.
+    Stats pooling and the final linear layer stay in fp32 to keep clustering quality.
+    """
+
+    def __init__(self, resnet):
+        super().__init__()
+        self.resnet = resnet
+
+    def forward(self, fbank, weights=None):
+        with torch.autocast("cuda", dtype=torch.float16):
+            frames = self.resnet.forward_frames(fbank)
+        return self.resnet.forward_embedding(frames.float(), weights=weights)
+
+def use_fp16_embedding(pipeline):
+    # Tensor cores are only available from compute capability 7.0 (Volta)
+    if not torch.cuda.is_available() or torch.cuda.get_device_capability()[0] < 7:
+        print("FP16 embedding is not supported on this device, using FP32.")
+        return
+    
+    print("Using FP16 autocast for the speaker-embedding model.")
+    model = pipeline._embedding.model_
+    model.resnet = AutocastResNet(model.resnet)
+
+def use_onnx_embedding(pipeline, onnx_model, quantized=False):
+    import onnxruntime
+    
+    if not os.path.exists(onnx_model):
+        print(f"Error: ONNX model not found - {onnx_model}")
+        print("Run scripts/export_embedding_onnx.py first.")
+        exit(1)
+    
+    if quantized:
+        # quantize_dynamic emits ConvInteger nodes, which have no CUDA kernel: with the CUDA EP
+        # they would fall back to CPU node by node anyway, so run the whole int8 model on CPU
+        providers = ["CPUExecutionProvider"]
+    elif torch.cuda.is_available():
+        # Run on the same GPU and CUDA stream as the pipeline (current device of multi-GPU
+        # workers), so the IO-bound input produced by PyTorch is ready when ONNX Runtime reads it
+        cuda_options = {
+            "device_id": torch.cuda.current_device(),
+            "user_compute_stream": str(torch.cuda.current_stream().cuda_stream)
+        }
+        providers = [("CUDAExecutionProvider", cuda_options), "CPUExecutionProvider"]
+    else:
+        providers = ["CPUExecutionProvider"]
+    session = onnxruntime.InferenceSession(onnx_model, providers=providers)
+    providers = session.get_providers()
+    print(f"Using ONNX Runtime embedding model: {onnx_model} ({', '.join(providers)})")
+    
+    # ONNX Runtime silently falls back to CPU when the CUDA EP cannot be loaded
+    # (CPU-only onnxruntime package, CUDA/cuDNN version mismatch, ...)
+    if not quantized and torch.cuda.is_available() and "CUDAExecutionProvider" not in providers:
+        print("WARNING: CUDAExecutionProvider is not available, the embedding model runs on CPU.")
+        print("Install onnxruntime-gpu matching the installed CUDA/cuDNN versions.")
+    
+    model = pipeline._embedding.model_
+    model.resnet = OnnxResNet(model.resnet, session)
+
+def get_embeddings_per_chunk(self, file, binary_segmentations, exclude_overlap=False, hook=None):
+    """
+    Faster SpeakerDiarization.get_embeddings (same inputs and output).
+    The original runs the embedding ResNet once per (chunk, speaker) pair. Here each chunk
+    goes through the ResNet once and stats pooling is done for all its local speakers
+    (weights of shape (batch, speakers, frames)). Chunks without any active speaker are skipped.
+    """
+    # Hyper-parameter optimization caches embeddings in the file: keep the original behaviour
+    if self.training:
+        return SpeakerDiarization.get_embeddings(self, file, binary_segmentations, exclude_overlap, hook)
+    
+    num_chunks, num_frames, num_speakers = binary_segmentations.data.shape
+    
+    # mask may contain NaN (in case of partial stitching)
+    masks = np.nan_to_num(binary_segmentations.data, nan=0.0).astype(np.float32)
+    
+    if exclude_overlap:
+        # Same rule as the original: use the non-overlapping frames of a speaker,
+        # unless they are too short to extract an embedding
+        num_samples = binary_segmentations.sliding_window.duration * self._embedding.sample_rate
+        min_num_frames = math.ceil(num_frames * self._embedding.min_num_samples / num_samples)
+        clean_masks = masks * (np.sum(binary_segmentations.data, axis=2, keepdims=True) < 2)
+        masks = np.where(np.sum(clean_masks, axis=1, keepdims=True) > min_num_frames, clean_masks, masks)
+    
+    masks = np.ascontiguousarray(masks.transpose(0, 2, 1))
+    # (num_chunks, num_speakers, num_frames)
+    
+    def crop_chunks(chunk_indices):
+        waveforms = [
+            self._audio.crop(file, binary_segmentations.sliding_window[c], mode="pad")[0][None]
+            for c in chunk_indices
+        ]
+        return torch.vstack(waveforms)
+        # (len(chunk_indices), 1, num_samples) torch.Tensor
+    
+    embeddings = np.empty((num_chunks, num_speakers, self._embedding.dimension), dtype=np.float32)
+    
+    active = masks.any(axis=(1, 2))
+    active_chunks = np.flatnonzero(active)
+    batch_count = math.ceil(len(active_chunks) / self.embedding_batch_size)
+    
+    if hook is not None:
+        hook("embeddings", None, total=batch_count, completed=0)
+    
+    for i, begin in enumerate(range(0, len(active_chunks), self.embedding_batch_size), 1):
+        chunk_indices = active_chunks[begin:begin + self.embedding_batch_size]
+        embedding_batch = self._embedding(crop_chunks(chunk_indices), masks=torch.from_numpy(masks[chunk_indices]))
+        # (batch_size, num_speakers, dimension) np.ndarray
+        embeddings[chunk_indices] = embedding_batch
+        
+        if hook is not None:
+            hook("embeddings", embedding_batch, total=batch_count, completed=i)
+    
+    # All-zero weights give zero pooled statistics, hence the same embedding whatever the
+    # audio: compute it once and reuse it for the skipped chunks (clustering ignores them)
+    inactive_chunks = np.flatnonzero(~active)
+    if len(inactive_chunks):
+        chunk_indices = inactive_chunks[:1]
+        embeddings[inactive_chunks] = self._embedding(crop_chunks(chunk_indices), masks=torch.from_numpy(masks[chunk_indices]))[0, 0]
+    
+    return embeddings
+
+def use_chunk_embeddings(pipeline):
+    # Only the WeSpeaker ResNet embedding model exposes the frame-wise stats pooling used above
+    if not hasattr(getattr(pipeline._embedding, "model_", None), "resnet"):
+        print("Per-chunk embedding extraction is not supported by this embedding model.")
+        return
+    
+    print("Using per-chunk speaker-embedding extraction.")
+    pipeline.get_embeddings = types.MethodType(get_embeddings_per_chunk, pipeline)
+
+def use_torch_compile(pipeline):
+    # torch.compile needs PyTorch 2.x
+    if not hasattr(torch, "compile"):
+        print("torch.compile is not available (PyTorch < 2.0), running eagerly.")
+        return
+    
+    # Fall back to eager execution instead of failing when a graph cannot be compiled
+    torch._dynamo.config.suppress_errors = True
+    
+    # Segmentation model and the ResNet of the embedding model (not the fbank computation).
+    # Only forward is replaced, so pyannote still sees the original modules.
+    modules = [pipeline._segmentation.model]
+    resnet = getattr(getattr(pipeline._embedding, "model_", None), "resnet", None)
+    if resnet is None or isinstance(resnet, OnnxResNet):
+        print("The embedding model is not compiled (not a PyTorch ResNet).")
+    else:
+        modules.append(resnet)
+    
+    # reduce-overhead: replay CUDA graphs to avoid per-kernel launch overhead at small batch sizes
+    for module in modules:
+        module.forward = torch.compile(module.forward, mode="reduce-overhead")
+    print("Using torch.compile (the first batches of each shape are slower while compiling).")
+
+def load_pipeline(onnx_model=None, embedding_batch_size=DEFAULT_BATCH_SIZE, segmentation_batch_size=DEFAULT_BATCH_SIZE, fp16=True, device=None, chunk_embeddings=True, torch_compile=False, quantized=False):
+    print("Loading Pyannote pipeline...")
     
     # Note: You need a valid HF token set in environment or passed to Pipeline
     # Assuming 'config.yaml' or pre-downloaded model, or using use_auth_token=True if logged in
     # For this script, we'll assume standard loading. 
     # If offline, path to model would be needed.
     
-    # Check for HF_TOKEN
+    # Check for HF_TOKEN (environment variable, or .env loaded at import time)
     hf_token = os.environ.get("HF_TOKEN")
     
-    # Try to load from .env if not in environment
-    if not hf_token and os.path.exists(".env"):
-        print("DEBUG: Loading HF_TOKEN from .env file...")
-        try:
-            with open(".env", "r") as f:
-                for line in f:
-                    line = line.strip()
-                    if line.startswith("HF_TOKEN="):
-                        hf_token = line.split("=", 1)[1].strip().strip('"').strip("'")
-                        os.environ["HF_TOKEN"] = hf_token
-                        break
-        except Exception as e:
-            print(f"DEBUG: Error reading .env file: {e}")
-
     if not hf_token:
         print("DEBUG: HF_TOKEN is NOT set in environment or .env.")
         print("WARNING: You must set HF_TOKEN to access the gated model.")
@@ -53,6 +260,11 @@ def diarize(input_file, num_speakers=None):
             }
         })
         
+        # Batch sizes are pipeline attributes, not hyper-parameters, so they are not part of instantiate()
+        pipeline.embedding_batch_size = embedding_batch_size
+        pipeline.segmentation_batch_size = segmentation_batch_size
+        print(f"DEBUG: Batch sizes - embedding: {embedding_batch_size}, segmentation: {segmentation_batch_size}")
+        
     except Exception as e:
         print(f"\nCRITICAL ERROR: Failed to load Pyannote pipeline.")
         print(f"Error details: {e}")
@@ -77,42 +289,184 @@ def diarize(input_file, num_speakers=None):
         traceback.print_exc()
         exit(1)
 
-    # Move to GPU if available
-    if torch.cuda.is_available():
-        pipeline.to(torch.device("cuda"))
-        print("Using GPU for diarization.")
+    # Move to GPU if available (multi-GPU workers pass their own cuda:N device)
+    if device is None and torch.cuda.is_available():
+        device = torch.device("cuda")
+    if device is not None:
+        pipeline.to(device)
+        print(f"Using GPU for diarization ({device}).")
     else:
         print("Using CPU for diarization.")
 
-    print("Starting diarization...")
+    # ONNX mode: replace the speaker-embedding ResNet with the ONNX Runtime model
+    # (otherwise run it under FP16 autocast on GPU)
+    if onnx_model:
+        use_onnx_embedding(pipeline, onnx_model, quantized)
+    elif fp16:
+        use_fp16_embedding(pipeline)
+    
+    if chunk_embeddings:
+        use_chunk_embeddings(pipeline)
+    
+    if torch_compile:
+        use_torch_compile(pipeline)
+
+    return pipeline
+
+def load_waveform(input_file):
+    """Decode the whole file once (mono, 16kHz) so the pipeline crops from memory"""
+    audio_io = Audio(sample_rate=16000, mono="downmix")
+    waveform, sample_rate = audio_io(input_file)
+    
+    # Keep the waveform on the GPU (the pipeline was moved there by load_pipeline)
+    # so resampling and chunk cropping run there instead of pinning a CPU core
+    # (.cuda() uses the current device, set per worker in diarize_worker)
+    if torch.cuda.is_available():
+        waveform = waveform.cuda()
+    # Keep the file name as RTTM uri (same as when passing the path)
+    return {"waveform": waveform, "sample_rate": sample_rate, "uri": Path(input_file).stem}
+
+def diarize_with_pipeline(pipeline, input_file, num_speakers=None):
+    print(f"Starting diarization for {input_file}...")
+    
+    # Passing a path makes the pipeline re-decode the file on every internal crop()
+    audio = load_waveform(input_file)
     
     # Run pipeline with num_speakers if provided
-    if num_speakers:
-        print(f"Running with fixed number of speakers: {num_speakers}")
-        diarization = pipeline(input_file, num_speakers=num_speakers)
-    else:
-        print("Running with automatic speaker detection")
-        diarization = pipeline(input_file)
+    # (inference_mode also skips autograd version-counter bookkeeping)
+    with torch.inference_mode():
+        if num_speakers:
+            print(f"Running with fixed number of speakers: {num_speakers}")
+            diarization = pipeline(audio, num_speakers=num_speakers)
+        else:
+            print("Running with automatic speaker detection")
+            diarization = pipeline(audio)
 
     # Handle DiarizeOutput object (pyannote-audio 3.1+)
     if hasattr(diarization, "speaker_diarization"):
         diarization = diarization.speaker_diarization
 
-    # Save to RTTM
-    output_file = input_file.replace(".wav", ".rttm")
+    # Save to RTTM (same lines as Annotation.write_rttm, formatted in one pass over the turns)
+    uri = diarization.uri or "<NA>"
+    if " " in uri:
+        raise ValueError(f"RTTM uri must not contain spaces: {uri}")
+    output_file = str(Path(input_file).with_suffix(".rttm"))
     with open(output_file, "w") as f:
-        diarization.write_rttm(f)
+        f.writelines(
+            f"SPEAKER {uri} 1 {segment.start:.3f} {segment.duration:.3f} <NA> <NA> {label} <NA> <NA>\n"
+            for segment, _, label in diarization.itertracks(yield_label=True)
+        )
 
     print(f"Diarization saved to {output_file}")
+    return output_file
+
+def diarize_worker(rank, queue, num_speakers, pipeline_options):
+    """Multi-GPU worker: load the pipeline once on cuda:{rank}, then diarize files from the queue until None"""
+    device = torch.device(f"cuda:{rank}")
+    torch.cuda.set_device(device)
+    pipeline = load_pipeline(device=device, **pipeline_options)
+    
+    while True:
+        input_file = queue.get()
+        if input_file is None:
+            break
+        diarize_with_pipeline(pipeline, input_file, num_speakers)
+
+def diarize(input_files, num_speakers=None, **pipeline_options):
+    if isinstance(input_files, str):
+        input_files = [input_files]
+    
+    # Single GPU / CPU: one pipeline processes the files sequentially
+    num_workers = min(torch.cuda.device_count(), len(input_files))
+    if num_workers <= 1:
+        pipeline = load_pipeline(**pipeline_options)
+        for input_file in input_files:
+            diarize_with_pipeline(pipeline, input_file, num_speakers)
+        return
+    
+    # Multiple GPUs: one worker process per GPU. Files are handed out through a
+    # shared queue, so a worker that finishes a short file takes the next one
+    print(f"Diarizing {len(input_files)} files on {num_workers} GPUs...")
+    queue = mp.get_context("spawn").Queue()
+    for input_file in input_files:
+        queue.put(input_file)
+    for _ in range(num_workers):
+        queue.put(None)
+    mp.spawn(diarize_worker, args=(queue, num_speakers, pipeline_options), nprocs=num_workers)
+
+def serve(**pipeline_options):
+    """
+    Persistent worker mode: load the pipeline once, then process jobs read from stdin.
+    Request (one JSON per line):  {"input": path, "num_speakers": int or null}
+    Response (one JSON per line): {"ok": true, "output": rttm_path} / {"ok": false, "error": message}
+    """
+    # stdout is reserved for responses: keep a private copy of fd 1 for them, then point
+    # fd 1 itself at stderr so that native libraries and child processes writing to it
+    # cannot corrupt the protocol (sys.stdout alone only covers Python-level writes)
+    sys.stdout.flush()
+    responses = os.fdopen(os.dup(1), "w", encoding="utf-8")
+    os.dup2(2, 1)
+    sys.stdout = sys.stderr
+    
+    pipeline = load_pipeline(**pipeline_options)
+    print("Worker ready.")
+    
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        try:
+            job = json.loads(line)
+            if not os.path.exists(job["input"]):
+                raise FileNotFoundError(f"File not found - {job['input']}")
+            output_file = diarize_with_pipeline(pipeline, job["input"], job.get("num_speakers"))
+            response = {"ok": True, "output": output_file}
+        except Exception as e:
+            print(f"Error: {e}")
+            response = {"ok": False, "error": str(e)}
+        responses.write(json.dumps(response, ensure_ascii=False) + "\n")
+        responses.flush()
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Step 2: Speaker Diarization using Pyannote")
-    parser.add_argument("--input", required=True, help="Path to input WAV file")
+    parser.add_argument("--input", nargs="+", help="Path(s) to input WAV file(s) (multiple files are spread over the available GPUs)")
     parser.add_argument("--num_speakers", type=int, help="Number of speakers (optional)")
+    parser.add_argument("--onnx", action="store_true", help="Use the FP32 ONNX Runtime speaker-embedding model (CUDA execution provider)")
+    parser.add_argument("--quantized", action="store_true", help="Use the int8 ONNX Runtime speaker-embedding model (always on the CPU execution provider)")
+    parser.add_argument("--onnx_model", help=f"Path to the ONNX embedding model (default: {DEFAULT_ONNX_MODEL}, or {DEFAULT_QUANTIZED_ONNX_MODEL} with --quantized)")
+    parser.add_argument("--embedding_batch_size", type=int, default=DEFAULT_BATCH_SIZE, help=f"Batch size of the speaker-embedding step (default: {DEFAULT_BATCH_SIZE})")
+    parser.add_argument("--segmentation_batch_size", type=int, default=DEFAULT_BATCH_SIZE, help=f"Batch size of the segmentation step (default: {DEFAULT_BATCH_SIZE})")
+    parser.add_argument("--no_fp16", action="store_true", help="Disable FP16 autocast of the speaker-embedding model on GPU")
+    parser.add_argument("--compile", action="store_true", help="Compile the segmentation and embedding models with torch.compile (worth it for --serve or many files)")
+    parser.add_argument("--no_chunk_embeddings", action="store_true", help="Use pyannote's original per-(chunk, speaker) embedding extraction")
+    parser.add_argument("--serve", action="store_true", help="Run as a persistent worker reading JSON jobs from stdin")
     args = parser.parse_args()
-
-    if not os.path.exists(args.input):
-        print(f"Error: File not found - {args.input}")
+    onnx_model = None
+    if args.quantized:
+        onnx_model = args.onnx_model or DEFAULT_QUANTIZED_ONNX_MODEL
+    elif args.onnx:
+        onnx_model = args.onnx_model or DEFAULT_ONNX_MODEL
+    
+    pipeline_options = {
+        "onnx_model": onnx_model,
+        "embedding_batch_size": args.embedding_batch_size,
+        "segmentation_batch_size": args.segmentation_batch_size,
+        "fp16": not args.no_fp16,
+        "chunk_embeddings": not args.no_chunk_embeddings,
+        "torch_compile": args.compile,
+        "quantized": args.quantized
+    }
+    
+    if args.serve:
+        serve(**pipeline_options)
+        exit(0)
+    
+    if not args.input:
+        print("Error: --input is required")
         exit(1)
 
-    diarize(args.input, args.num_speakers)
+    for input_file in args.input:
+        if not os.path.exists(input_file):
+            print(f"Error: File not found - {input_file}")
+            exit(1)
+
+    diarize(args.input, args.num_speakers, **pipeline_options)
@@ -1,149 +1,288 @@
 import argparse
+import codecs
+import collections
 import json
+import numpy as np
 import pandas as pd
 import os
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 
-from pyannote.core import Segment, Annotation
-
-def load_rttm_as_annotation(rttm_path):
-    """RTTMファイルを読み込んでAnnotationオブジェクトにする"""
-    annotation = Annotation()
-    with open(rttm_path, 'r') as f:
-        for line in f:
-            parts = line.strip().split()
-            if len(parts) < 9: continue
-            start = float(parts[3])
-            duration = float(parts[4])
-            end = start + duration
-            speaker = parts[7]
-            annotation[Segment(start, end)] = speaker
-    return annotation
-
-def get_dominant_speaker(annotation, start, end):
-    """指定区間で最も長く話している話者を返す"""
-    segment = Segment(start, end)
-    # cropにより、この区間内の話者ラベルとその長さを取得
-    cropped = annotation.crop(segment)
-    labels = {}
-    for seg, _, label in cropped.itertracks(yield_label=True):
-        dur = seg.duration
-        labels[label] = labels.get(label, 0) + dur
-    
-    if not labels:
+# orjsonがあれば単語タイムスタンプ付きの大きなJSONを高速に読み込む（なければ標準のjson）
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# pyarrowがあれば結果CSVをC++のCSVライターで書き出す（なければpandasで書き出す）
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pacsv
+except ImportError:
+    pa = None
+
+# numbaがあれば集計ループをJITコンパイルする（なければ通常のPython関数として実行）
+try:
+    from numba import njit
+except ImportError:
+    def njit(*args, **kwargs):
+        return lambda func: func
+
+# Segment/Annotationの代わりに、話者区間を配列の組 (SoA) で保持する
+# starts/ends: 区間の開始・終了時刻 (開始時刻順), codes: 話者番号, labels: 話者番号 -> 話者名
+# end_max: endsの累積最大値 (区間が重なっていても二分探索で検索範囲を絞るため)
+SpeakerTurns = collections.namedtuple("SpeakerTurns", ["starts", "ends", "codes", "labels", "end_max"])
+
+# これより短い区間は空とみなす (pyannote.core の SEGMENT_PRECISION と同じ)
+SEGMENT_PRECISION = 1e-6
+
+def load_transcript(json_path):
+    """Whisperの結果JSON (step1_transcribe.pyの出力) を読み込む"""
+    if orjson is not None:
+        with open(json_path, 'rb') as f:
+            return orjson.loads(f.read())
+    with open(json_path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def read_rttm(rttm_path):
+    """RTTMファイルを (start, duration, speaker) のDataFrameとして読み込む（空ファイルなら空のDataFrame）"""
+    # 行ごとのsplit()/float()を避け、pandasのCパーサーで一括変換する
+    return pd.read_csv(
+        rttm_path,
+        sep=r"\s+",
+        header=None,
+        usecols=[3, 4, 7],
+        names=["start", "duration", "speaker"],
+        dtype={"start": "float64", "duration": "float64", "speaker": str},
+        engine="c"
+    )
+
+def load_rttm_turns(rttm_path):
+    """RTTMファイルを読み込んでSpeakerTurnsにする"""
+    df = read_rttm(rttm_path)
+    df["end"] = df["start"] + df["duration"]
+    # 空の区間は除き、同じ区間が複数回現れた場合は後の話者を採用する
+    df = df[df["end"] - df["start"] > SEGMENT_PRECISION]
+    df = df.drop_duplicates(subset=["start", "end"], keep="last")
+    df = df.sort_values(["start", "end"], kind="stable")
+
+    codes, labels = pd.factorize(df["speaker"])
+    ends = df["end"].to_numpy()
+    return SpeakerTurns(
+        starts=df["start"].to_numpy(),
+        ends=ends,
+        codes=codes,
+        labels=labels.to_numpy(),
+        end_max=np.maximum.accumulate(ends) if len(ends) else ends
+    )
+
+def find_turn_windows(turns, seg_starts, seg_ends):
+    """
+    全Whisperセグメントについて、重なりうる話者区間の範囲 [lo, hi) をまとめて求める。
+    end_max <= start の区間と、start >= end の区間は重ならないので除外する。
+    (セグメントが時刻順のため、二分探索は前回の位置から進むだけの走査になる)
+    """
+    los = np.searchsorted(turns.end_max, seg_starts, side="right")
+    his = np.searchsorted(turns.starts, seg_ends, side="left")
+    return los, his
+
+def crop_turns(turns, start, end, lo, hi):
+    """
+    指定区間と重なる話者区間 (turnsの[lo, hi)の範囲) を切り出し、(開始, 終了, 話者番号) の配列で返す。
+    各区間は指定区間との共通部分に縮め、時刻順 (開始→終了) に並べる。
+    """
+    crop_starts = np.maximum(turns.starts[lo:hi], start)
+    crop_ends = np.minimum(turns.ends[lo:hi], end)
+    codes = turns.codes[lo:hi]
+    
+    keep = crop_ends - crop_starts > SEGMENT_PRECISION
+    crop_starts, crop_ends, codes = crop_starts[keep], crop_ends[keep], codes[keep]
+    order = np.lexsort((crop_ends, crop_starts))
+    crop_starts, crop_ends, codes = crop_starts[order], crop_ends[order], codes[order]
+    
+    # 切り出し後に同じ区間になった話者が複数ある場合は、Annotation.crop と同じ順
+    # (最初の区間が最後、残りは元の順) に並べ替える
+    is_first = np.ones(len(codes), dtype=bool)
+    is_first[1:] = (crop_starts[1:] != crop_starts[:-1]) | (crop_ends[1:] != crop_ends[:-1])
+    if not is_first.all():
+        group_ids = np.cumsum(is_first) - 1
+        group_heads = np.flatnonzero(is_first)
+        group_sizes = np.diff(np.append(group_heads, len(codes)))
+        positions = np.arange(len(codes)) - group_heads[group_ids]
+        ranks = np.where(positions == 0, group_sizes[group_ids], positions)
+        order = np.lexsort((ranks, group_ids))
+        crop_starts, crop_ends, codes = crop_starts[order], crop_ends[order], codes[order]
+    
+    return crop_starts, crop_ends, codes
+
+@njit(cache=True)
+def dominant_code(codes, durations, num_speakers):
+    """話者ごとの発話時間を合計し、最も長い話者番号を返す（同じ長さなら先に現れた話者）"""
+    totals = np.zeros(num_speakers)
+    for i in range(len(codes)):
+        totals[codes[i]] += durations[i]
+    
+    best = codes[0]
+    for i in range(1, len(codes)):
+        if totals[codes[i]] > totals[best]:
+            best = codes[i]
+    return best
+
+def get_dominant_speaker(turns, crop_starts, crop_ends, codes):
+    """切り出した話者区間 (crop_turnsの結果) のうち、最も長く話している話者を返す"""
+    if len(codes) == 0:
         return "Unknown"
     
     # 最も長い話者を返す
-    return max(labels, key=labels.get)
+    return turns.labels[dominant_code(codes, crop_ends - crop_starts, len(turns.labels))]
 
-def split_segment_by_speaker(whisper_segment, annotation):
+@njit(cache=True)
+def advance_groups(reachable):
     """
-    1つのWhisperセグメント内に明確な話者交代がある場合、分割してリストで返す。
+    reachable[i]: i番目の単語の開始時点で越えている境界の数。
+    単語ごとに境界を1つずつ進めた場合の所属区間を返す。
+    """
+    groups = np.empty_like(reachable)
+    current = 0
+    for i in range(len(reachable)):
+        if reachable[i] > current:
+            current += 1
+        groups[i] = current
+    return groups
+
+@njit(cache=True)
+def has_overlap(starts, ends, seg_starts, seg_ends, los, his):
+    """各Whisperセグメントが、検索範囲 [lo, hi) のいずれかの話者区間と重なっているかを返す"""
+    result = np.zeros(len(seg_starts), dtype=np.bool_)
+    for i in range(len(seg_starts)):
+        for j in range(los[i], his[i]):
+            if min(ends[j], seg_ends[i]) - max(starts[j], seg_starts[i]) > SEGMENT_PRECISION:
+                result[i] = True
+                break
+    return result
+
+def split_segment_by_speaker(whisper_segment, turns, lo, hi):
+    """
+    1つのWhisperセグメント内に明確な話者交代がある場合、分割して (開始, 終了, 話者, テキスト) のリストで返す。
     交代がない場合は、リストに1つだけ入れて返す。
+    lo, hi: このセグメントと重なりうる話者区間の範囲 (find_turn_windowsの結果)
     """
     seg_start = whisper_segment['start']
     seg_end = whisper_segment['end']
     text = whisper_segment['text']
     words = whisper_segment.get('words', [])
 
+    # このセグメント内の話者区間を一度だけ切り出す
+    crop_starts, crop_ends, codes = crop_turns(turns, seg_start, seg_end, lo, hi)
+
     # 単語情報がない場合は分割できないのでそのまま返す
     if not words:
-        spk = get_dominant_speaker(annotation, seg_start, seg_end)
-        return [{"Start": seg_start, "End": seg_end, "Speaker": spk, "Text": text}]
+        spk = get_dominant_speaker(turns, crop_starts, crop_ends, codes)
+        return [(seg_start, seg_end, spk, text)]
 
     # Pyannote上で、このセグメント内に「話者の境界線」があるか探す
     # 判定基準: 0.5秒以上の発言が2つ以上含まれているか？
-    segment_annot = annotation.crop(Segment(seg_start, seg_end))
     
     # 簡易的なチェンジポイント検出
-    # (話者ラベル, 開始時間) のリストを作成
-    changes = []
-    for s, _, label in segment_annot.itertracks(yield_label=True):
-        # 短すぎるノイズ判定は無視 (例: 0.2秒以下)
-        if s.duration > 0.2:
-            changes.append((label, s.start, s.end))
-    
-    # 変化点を時系列順にソート
-    changes.sort(key=lambda x: x[1])
+    # 短すぎるノイズ判定は無視 (例: 0.2秒以下)
+    # (crop_turnsの結果は既に開始時刻順)
+    is_long = crop_ends - crop_starts > 0.2
+    change_starts = crop_starts[is_long]
+    change_codes = codes[is_long]
 
     # 明確な話者変更がないなら、そのまま
-    unique_speakers = set(c[0] for c in changes)
-    if len(unique_speakers) <= 1:
-        spk = get_dominant_speaker(annotation, seg_start, seg_end)
-        return [{"Start": seg_start, "End": seg_end, "Speaker": spk, "Text": text}]
+    if len(np.unique(change_codes)) <= 1:
+        spk = get_dominant_speaker(turns, crop_starts, crop_ends, codes)
+        return [(seg_start, seg_end, spk, text)]
 
     # --- 分割ロジック ---
     # 話者が変わるタイミングを見つけて、単語リストを分割する
     
-    split_segments = []
-    current_words = []
-    current_spk = changes[0][0] # 最初の話者
-    
-    # 2人目以降の話者が始まるタイミングをリスト化
-    # changes = [('A', 10.0, 12.0), ('B', 12.1, 15.0)] -> boundaries = [(12.1, 'B')]
-    boundaries = []
-    for i in range(1, len(changes)):
-        prev_spk = changes[i-1][0]
-        curr_spk = changes[i][0]
-        curr_start = changes[i][1]
-        
-        if prev_spk != curr_spk:
-            boundaries.append((curr_start, curr_spk))
+    # 2人目以降の話者が始まるタイミングを配列化
+    # 話者 A(10.0-12.0), B(12.1-15.0) -> boundary_times = [12.1], 区間ごとの話者 = [A, B]
+    is_change = np.concatenate(([True], change_codes[1:] != change_codes[:-1]))
+    boundary_times = change_starts[is_change][1:]
+    group_speakers = turns.labels[change_codes[is_change]]
     
-    boundary_idx = 0
+    # 各単語がどの話者区間に属するかを一括で求める
+    # 単語の開始時間が、話者変更点(の0.1秒手前)を超えたら次の区間
+    w_starts = np.fromiter((w['start'] for w in words), dtype=np.float64, count=len(words))
+    groups = np.searchsorted(boundary_times - 0.1, w_starts, side="right")
     
-    for word in words:
-        w_start = word['start']
-        w_end = word['end']
-        
-        # 次の境界を超えたかチェック
-        if boundary_idx < len(boundaries):
-            next_boundary_time, next_spk = boundaries[boundary_idx]
-            
-            # 単語の開始時間が、話者変更点を超えたら分割
-            # (少し余裕を持たせるため +0.1秒などの調整もありだが、基本は素直に比較)
-            if w_start >= next_boundary_time - 0.1: 
-                # これまでのバッファを保存
-                if current_words:
-                    split_segments.append({
-                        "Start": current_words[0]['start'],
-                        "End": current_words[-1]['end'],
-                        "Speaker": current_spk,
-                        "Text": "".join([w['word'] for w in current_words])
-                    })
-                
-                # 新しい話者に切り替え
-                current_spk = next_spk
-                current_words = []
-                boundary_idx += 1
-        
-        current_words.append(word)
-    
-    # 残りのバッファを保存
-    if current_words:
-        split_segments.append({
-            "Start": current_words[0]['start'],
-            "End": current_words[-1]['end'],
-            "Speaker": current_spk,
-            "Text": "".join([w['word'] for w in current_words])
-        })
+    # 境界は1単語につき1つずつしか進めない（単語のない短い発言を飛び越えた場合も次の区間へ進むだけ）
+    steps = np.diff(groups, prepend=0)
+    if np.any((steps < 0) | (steps > 1)):
+        groups = advance_groups(groups)
+    
+    # 区間が切り替わる位置で単語リストを分割する
+    split_points = np.flatnonzero(groups[1:] != groups[:-1]) + 1
+    bounds = [0] + split_points.tolist() + [len(words)]
+    
+    split_segments = []
+    for begin, stop in zip(bounds[:-1], bounds[1:]):
+        split_segments.append((
+            words[begin]['start'],
+            words[stop - 1]['end'],
+            group_speakers[groups[begin]],
+            "".join(w['word'] for w in words[begin:stop])
+        ))
         
     return split_segments
 
 def merge_transcription_and_diarization(whisper_result, diarization_result):
-    final_data = []
+    # 全セグメントの検索範囲を1回の走査で求める
+    seg_starts = np.fromiter((seg['start'] for seg in whisper_result), dtype=np.float64, count=len(whisper_result))
+    seg_ends = np.fromiter((seg['end'] for seg in whisper_result), dtype=np.float64, count=len(whisper_result))
+    los, his = find_turn_windows(diarization_result, seg_starts, seg_ends)
     
-    for segment in whisper_result:
+    # 話者が1人だけの場合は分割が起こらないため、区間と重なるかどうかだけで話者を決める
+    # (どの区間とも重ならないセグメントは通常の処理と同じく "Unknown")
+    if len(diarization_result.labels) == 1:
+        overlap = has_overlap(diarization_result.starts, diarization_result.ends, seg_starts, seg_ends, los, his)
+        return pd.DataFrame({
+            "Start": seg_starts,
+            "End": seg_ends,
+            "Speaker": pd.Categorical(np.where(overlap, diarization_result.labels[0], "Unknown")),
+            "Text": [seg['text'] for seg in whisper_result]
+        })
+    
+    # 列ごとのリストに貯め、行の辞書を作らずにDataFrameにする
+    starts, ends, speakers, texts = [], [], [], []
+    for segment, lo, hi in zip(whisper_result, los.tolist(), his.tolist()):
         # このセグメントを（必要なら）分割して取得
-        processed_segments = split_segment_by_speaker(segment, diarization_result)
-        final_data.extend(processed_segments)
-            
-    return pd.DataFrame(final_data)
+        for start, end, speaker, text in split_segment_by_speaker(segment, diarization_result, lo, hi):
+            starts.append(start)
+            ends.append(end)
+            speakers.append(speaker)
+            texts.append(text)
+    
+    # 話者列はカテゴリ型にする（話者名を行ごとに保持しない）
+    return pd.DataFrame({
+        "Start": np.asarray(starts, dtype=np.float64),
+        "End": np.asarray(ends, dtype=np.float64),
+        "Speaker": pd.Categorical(speakers),
+        "Text": texts
+    })
+
+def write_csv(df, output_csv):
+    """結果をBOM付きUTF-8 (Excelで文字化けしない形式) のCSVに書き出す"""
+    if pa is None:
+        df.to_csv(output_csv, index=False, encoding='utf-8-sig')
+        return
+    
+    # pyarrowは文字列を常に引用符で囲み、整数値の小数は "1" のように書く
+    # (読み込む側は Start/End を小数として読むこと: app.py の read_result_csv)
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    with open(output_csv, 'wb') as f:
+        f.write(codecs.BOM_UTF8)
+        pacsv.write_csv(table, f)
 
 def merge_results(wav_path, output_csv=None):
-    json_path = wav_path.replace(".wav", ".json")
-    rttm_path = wav_path.replace(".wav", ".rttm")
+    wav_path = Path(wav_path)
+    json_path = wav_path.with_suffix(".json")
+    rttm_path = wav_path.with_suffix(".rttm")
     if output_csv is None:
-        output_csv = wav_path.replace(".wav", "_final.csv")
+        output_csv = wav_path.with_name(f"{wav_path.stem}_final.csv")
 
     if not os.path.exists(json_path):
         print(f"Error: JSON transcript not found at {json_path}")
@@ -153,15 +292,57 @@ def merge_results(wav_path, output_csv=None):
         exit(1)
 
     print("Loading data...")
-    with open(json_path, 'r', encoding='utf-8') as f:
-        transcript_segments = json.load(f)
+    transcript_segments = load_transcript(json_path)
     
-    diarization_annotation = load_rttm_as_annotation(rttm_path)
+    diarization_turns = load_rttm_turns(rttm_path)
 
     print("Merging segments (Diarization-Guided Splitting)...")
-    df = merge_transcription_and_diarization(transcript_segments, diarization_annotation)
+    df = merge_transcription_and_diarization(transcript_segments, diarization_turns)
     
-    df.to_csv(output_csv, index=False, encoding='utf-8-sig')
+    write_csv(df, output_csv)
+    print(f"Merged result saved to {output_csv}")
+
+def load_channel_segments(json_path, speaker):
+    """1チャネル分のWhisper結果を読み込み、固定の話者ラベルを付けたDataFrameにする"""
+    transcript_segments = load_transcript(json_path)
+    
+    df = pd.DataFrame(transcript_segments, columns=["start", "end", "text"])
+    df.columns = ["Start", "End", "Text"]
+    df.insert(2, "Speaker", speaker)
+    return df
+
+def merge_multi_channel(wav_paths, output_csv, channel_speakers=None, parallel=False):
+    """
+    チャネル分離モード: 1チャネル = 1話者 として各チャネルのWhisper結果を統合する。
+    話者はチャネルから確定しているため、Pyannoteの話者分離(RTTM)は使用しない。
+    parallel=True の場合、各チャネルのJSONをスレッドで並列に読み込む。
+    """
+    if channel_speakers is None:
+        channel_speakers = [f"SPEAKER_CH{i+1}" for i in range(len(wav_paths))]
+    if len(channel_speakers) != len(wav_paths):
+        print("Error: --channel_speakers must have the same length as --input_wavs")
+        exit(1)
+
+    json_paths = [Path(wav_path).with_suffix(".json") for wav_path in wav_paths]
+    for json_path in json_paths:
+        if not os.path.exists(json_path):
+            print(f"Error: JSON transcript not found at {json_path}")
+            exit(1)
+
+    print("Loading data...")
+    if parallel:
+        with ThreadPoolExecutor() as executor:
+            channel_dfs = list(executor.map(load_channel_segments, json_paths, channel_speakers))
+    else:
+        channel_dfs = [load_channel_segments(p, spk) for p, spk in zip(json_paths, channel_speakers)]
+
+    print("Merging channels (fixed speaker per channel, no diarization)...")
+    # 発言のないチャネルは連結対象から外す（全チャネル空の場合は空のDataFrameのまま）
+    df = pd.concat([d for d in channel_dfs if not d.empty] or channel_dfs[:1], ignore_index=True)
+    # 全チャネルの発言を時系列に並べる（同時刻はチャネル順を維持）
+    df = df.sort_values("Start", kind="stable").reset_index(drop=True)
+
+    write_csv(df, output_csv)
     print(f"Merged result saved to {output_csv}")
 
 if __name__ == "__main__":
@@ -169,6 +350,8 @@ if __name__ == "__main__":
     parser.add_argument("--input_wav", help="Path to input WAV file (Single mode)")
     parser.add_argument("--multi_mode", action="store_true", help="Enable multi-channel merge mode")
     parser.add_argument("--input_wavs", nargs="+", help="List of input WAV files (Multi mode)")
+    parser.add_argument("--channel_speakers", nargs="+", help="Speaker label for each input WAV (Multi mode, default: SPEAKER_CH1, SPEAKER_CH2, ...)")
+    parser.add_argument("--parallel", action="store_true", help="Load the per-channel JSON files in parallel (Multi mode)")
     parser.add_argument("--output", help="Path to output CSV file")
     
     args = parser.parse_args()
@@ -177,7 +360,7 @@ if __name__ == "__main__":
         if not args.input_wavs or not args.output:
             print("Error: --input_wavs and --output are required for multi mode")
             exit(1)
-        merge_multi_channel(args.input_wavs, args.output)
+        merge_multi_channel(args.input_wavs, args.output, args.channel_speakers, args.parallel)
     else:
         if not args.input_wav:
             print("Error: --input_wav is required for single mode")